@@ -1,45 +1,77 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Blueprint, Flask, Response, abort, current_app, g, has_request_context, render_template, request, redirect, url_for, flash, session, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
+from flask_sqlalchemy.session import Session
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects.postgresql import ExcludeConstraint, insert as pg_insert
+from itsdangerous import BadSignature, URLSafeSerializer
+from datetime import date, datetime, timedelta, timezone
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
+from functools import lru_cache, wraps
+import hmac
 import os
-from dotenv import load_dotenv
 import json
+import time
+import uuid
 
+import export
+import ics
+from auth import SessionVersionCache, decode_auth, encode_auth
+from fragment_cache import BundledBytecodeCache, FragmentCacheExtension
+from intervals import IntervalIndex, IntervalIndexCache
+from replicas import ReplicaPool
 
-load_dotenv()
 
-APP_SECRET_KEY = os.getenv("APP_SECRET_KEY")
-PGHOST = os.getenv("PGHOST")
-PGUSER = os.getenv("PGUSER")
-PGDATABASE = os.getenv("PGDATABASE")
-PGPASSWORD = os.getenv("PGPASSWORD")
-LANGUAGE = os.getenv("LANGUAGE")
-REGISTER_ENABLED = os.getenv("REGISTER_ENABLED", "false")
+JINJA_BUNDLED_CACHE_DIR = 'jinja_cache'
+FEED_BATCH_SIZE = 500
+EXPORT_BATCH_SIZE = 10000
+EXPORT_DATASETS = ('reservations', 'user_stats')
+ANALYTICS_DEFAULT_DAYS = 28
+# Longest reservation accepted, it bounds the start_time range scanned by the booking checks
+MAX_RESERVATION_DURATION = timedelta(days=1)
+ANALYTICS_MAX_DAYS = 731
+# Past reservations shown by the calendar, and kept in the in-memory index
+CALENDAR_HISTORY = timedelta(weeks=1)
+JOB_BATCH_SIZE = 20
+JOB_MAX_ATTEMPTS = 5
+# A running job not finished within this time is assumed lost with its worker and run again
+JOB_TIMEOUT = timedelta(minutes=10)
+JOB_RETENTION = timedelta(days=1)
 
 
-app = Flask(__name__)
-app.secret_key = APP_SECRET_KEY
+class RoutingSession(Session):
+    """Sends the reads of the read-only views to the replica picked for the request.
 
-# Determine the schema based on the environment
-schema = 'unit_tests' if os.getenv('FLASK_ENV') == 'testing' else 'runtime'
+    Flushes and every other statement go to the primary, and a request that wrote
+    keeps the user's next reads on the primary (see pin_reads_to_primary).
+    """
 
-# SQLAlchemy Configuration for PostgreSQL
-app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql+psycopg2://{PGUSER}:{PGPASSWORD}@{PGHOST}/{PGDATABASE}'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'execution_options': {
-        'schema_translate_map': {None: schema}
-    }
-}
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and getattr(clause, 'is_select', False):
+            replica = g.get('read_replica')
+            if replica:
+                return self._db.engines[replica]
+        elif has_request_context():
+            g.wrote_to_primary = True
+            # The replica has not seen the write yet, the rest of the request reads from the primary
+            g.pop('read_replica', None)
+        if bind is None and self.bind is not None:
+            # Bound to a connection, e.g. the outer transaction of a test
+            return self.bind
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+bp = Blueprint('main', __name__, cli_group=None)
 
 class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
+    # 'user', 'admin' or 'disabled'
+    role = db.Column(db.String(20), nullable=False, default='user', server_default='user')
+    # Bumped to revoke every session issued to the user
+    session_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 class Reservation(db.Model):
     __tablename__ = 'reservations'
@@ -49,23 +81,700 @@ class Reservation(db.Model):
     end_time = db.Column(db.DateTime, nullable=False)
     user = db.relationship('User', backref='reservations')
 
-def load_language():
-    with open(f'{LANGUAGE}.json', encoding='utf-8') as f:
+    __table_args__ = (
+        db.Index('ix_reservations_user_id_start_time', 'user_id', 'start_time'),
+        db.Index('ix_reservations_start_time', 'start_time'),
+    )
+
+# The source of truth against double bookings, whatever checks ran before the insert
+Reservation.__table__.append_constraint(ExcludeConstraint(
+    (db.func.tsrange(Reservation.start_time, Reservation.end_time), '&&'),
+    name='ex_reservations_no_overlap', using='gist',
+))
+
+class WaitlistEntry(db.Model):
+    """A request for a taken slot, turned into a reservation when the slot is freed."""
+    __tablename__ = 'waitlist'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'start_time', 'end_time', name='uq_waitlist_user_id_time'),
+    )
+
+# Serves the range overlap (&&) lookup of the entries that may fit a freed slot
+db.Index('ix_waitlist_time_range', db.func.tsrange(WaitlistEntry.start_time, WaitlistEntry.end_time),
+         postgresql_using='gist')
+
+class IdempotencyKey(db.Model):
+    """Outcome of a reservation submission, replayed when the same submission is retried."""
+    __tablename__ = 'idempotency_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    key = db.Column(db.String(64), nullable=False)
+    message = db.Column(db.String(255), nullable=False)
+    category = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'key', name='uq_idempotency_keys_user_id_key'),
+        db.Index('ix_idempotency_keys_created_at', 'created_at'),
+    )
+
+class OccupancyHour(db.Model):
+    """Occupied minutes of every hour of the closed days, computed once from the reservations."""
+    __tablename__ = 'occupancy_hours'
+    hour = db.Column(db.DateTime, primary_key=True)
+    minutes = db.Column(db.Integer, nullable=False)
+
+class Revision(db.Model):
+    """Change counter of a table, bumped in the same transaction as every write."""
+    __tablename__ = 'revisions'
+    name = db.Column(db.String(50), primary_key=True)
+    number = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+class Job(db.Model):
+    """Work done outside the requests, claimed by the workers with SELECT ... FOR UPDATE SKIP LOCKED."""
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    # Optional unique key, scheduling a job with the key of an existing one does nothing
+    key = db.Column(db.String(100), unique=True)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    # 'queued', 'running', 'done' or 'failed'
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    run_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    started_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(255))
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+
+def create_app():
+    # Deployments inject their environment directly, .env files are for local runs
+    if not os.getenv("VERCEL"):
+        from dotenv import load_dotenv
+        load_dotenv()
+
+    app = Flask(__name__)
+    app.secret_key = os.getenv("APP_SECRET_KEY")
+    app.config['LANGUAGE'] = os.getenv("LANGUAGE")
+    app.config['REGISTER_ENABLED'] = os.getenv("REGISTER_ENABLED", "false")
+    app.config['SESSION_MAX_AGE'] = int(os.getenv("SESSION_MAX_AGE_DAYS", "30")) * 24 * 3600
+    app.config['SESSION_VERSION_TTL'] = int(os.getenv("SESSION_VERSION_TTL", "60"))
+    app.config['IDEMPOTENCY_KEY_TTL'] = timedelta(hours=int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24")))
+    # Booking rules, 0 disables a rule
+    app.config['BOOKING_RULES'] = {
+        'max_active_reservations': int(os.getenv("MAX_ACTIVE_RESERVATIONS", "0")),
+        'max_hours_per_week': int(os.getenv("MAX_HOURS_PER_WEEK", "0")),
+        'max_lead_days': int(os.getenv("MAX_LEAD_DAYS", "0")),
+        'min_gap_minutes': int(os.getenv("MIN_GAP_MINUTES", "0")),
+    }
+
+    # Keep compiled templates on disk across cold starts and enable {% cache %} fragments.
+    # A jinja_cache folder filled before the deployment is shipped with the serverless function
+    jinja_cache_dir = os.getenv("JINJA_CACHE_DIR")
+    if jinja_cache_dir:
+        os.makedirs(jinja_cache_dir, exist_ok=True)
+    elif os.path.isdir(os.path.join(app.root_path, JINJA_BUNDLED_CACHE_DIR)):
+        jinja_cache_dir = os.path.join(app.root_path, JINJA_BUNDLED_CACHE_DIR)
+    app.jinja_options = {
+        **app.jinja_options,
+        'bytecode_cache': BundledBytecodeCache(jinja_cache_dir),
+        'extensions': [FragmentCacheExtension],
+    }
+
+    # Determine the schema based on the environment, parallel test workers (pytest-xdist) get one each
+    schema = 'runtime'
+    if os.getenv('FLASK_ENV') == 'testing':
+        worker = os.getenv('PYTEST_XDIST_WORKER')
+        schema = f'unit_tests_{worker}' if worker else 'unit_tests'
+
+    # SQLAlchemy Configuration for PostgreSQL, no connection is opened until the first query
+    PGHOST = os.getenv("PGHOST")
+    PGUSER = os.getenv("PGUSER")
+    PGDATABASE = os.getenv("PGDATABASE")
+    PGPASSWORD = os.getenv("PGPASSWORD")
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql+psycopg2://{PGUSER}:{PGPASSWORD}@{PGHOST}/{PGDATABASE}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'execution_options': {
+            'schema_translate_map': {None: schema}
+        }
+    }
+
+    # Optional read replicas with the same credentials, used by the read-only views
+    app.config['REPLICA_CONNECT_TIMEOUT'] = int(os.getenv("REPLICA_CONNECT_TIMEOUT", "2"))
+    replica_hosts = [host.strip() for host in os.getenv("READ_REPLICA_HOSTS", "").split(",") if host.strip()]
+    app.config['SQLALCHEMY_BINDS'] = {
+        f'replica_{number}': {
+            **app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+            'url': f'postgresql+psycopg2://{PGUSER}:{PGPASSWORD}@{host}/{PGDATABASE}',
+            'pool_pre_ping': True,
+            # Health checks run in requests, an unreachable replica must fail fast
+            'connect_args': {'connect_timeout': app.config['REPLICA_CONNECT_TIMEOUT']},
+        }
+        for number, host in enumerate(replica_hosts)
+    }
+    app.config['REPLICA_CHECK_INTERVAL'] = int(os.getenv("REPLICA_CHECK_INTERVAL", "30"))
+    app.config['READ_YOUR_WRITES_SECONDS'] = int(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+
+    # Background jobs, run by `flask run-jobs` or by calls to /cron/jobs
+    app.config['CRON_SECRET'] = os.getenv("CRON_SECRET")
+    app.config['CRON_TIME_BUDGET'] = int(os.getenv("CRON_TIME_BUDGET_SECONDS", "20"))
+    app.config['REMINDER_MINUTES'] = int(os.getenv("REMINDER_MINUTES", "0"))
+    app.config['REMINDER_WEBHOOK_URL'] = os.getenv("REMINDER_WEBHOOK_URL")
+
+    # In-memory index of the recent and upcoming reservations
+    app.config['INTERVAL_INDEX'] = os.getenv("INTERVAL_INDEX", "false") == "true"
+    app.config['INTERVAL_INDEX_TTL'] = int(os.getenv("INTERVAL_INDEX_TTL", "5"))
+
+    db.init_app(app)
+    app.register_blueprint(bp)
+    app.extensions['session_versions'] = SessionVersionCache(load_session_versions, app.config['SESSION_VERSION_TTL'])
+    app.extensions['read_replicas'] = ReplicaPool(app.config['SQLALCHEMY_BINDS'], replica_healthy,
+                                                  app.config['REPLICA_CHECK_INTERVAL'])
+    app.extensions['reservation_index'] = (
+        IntervalIndexCache(load_reservation_index, reservations_revision, app.config['INTERVAL_INDEX_TTL'])
+        if app.config['INTERVAL_INDEX'] else None
+    )
+
+    # Serverless platforms run module import before the first invocation, so connect there
+    if os.getenv("WARM_UP_ON_START", "true" if os.getenv("VERCEL") else "false") == "true":
+        warm_up(app)
+
+    return app
+
+
+def ensure_schema():
+    """Create the database tables once per process."""
+    if not current_app.extensions.get('schema_ready'):
+        db.create_all()
+        current_app.extensions['schema_ready'] = True
+
+
+def warm_up(app):
+    """Create the schema, leave one established connection in the pool and load the reservation index."""
+    with app.app_context():
+        try:
+            ensure_schema()
+            with db.engine.connect():
+                pass
+            if app.extensions['reservation_index']:
+                app.extensions['reservation_index'].current()
+        except OperationalError:
+            # The app must still load, the first requests connect again
+            app.logger.warning('Warm-up failed, the database is unavailable', exc_info=True)
+
+
+def replica_healthy(name):
+    try:
+        with db.engines[name].connect() as connection:
+            connection.execute(db.select(1))
+    except OperationalError:
+        current_app.logger.warning('Read replica %s is unavailable, reading from the primary', name)
+        return False
+    return True
+
+def read_only(view):
+    """Serve the reads of a view from a replica, unless the user wrote something moments ago."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions['read_replicas']
+        if replicas and session.get('read_primary_until', 0) <= time.time():
+            g.read_replica = replicas.pick()
+        return view(*args, **kwargs)
+    return wrapper
+
+@bp.after_app_request
+def pin_reads_to_primary(response):
+    # Replicas lag behind, the user's next reads come from the primary to show what they just changed
+    if g.get('wrote_to_primary') and current_app.extensions['read_replicas']:
+        session['read_primary_until'] = int(time.time()) + current_app.config['READ_YOUR_WRITES_SECONDS']
+    return response
+
+
+@lru_cache(maxsize=None)
+def read_language_file(language):
+    with open(f'{language}.json', encoding='utf-8') as f:
         return json.load(f)
 
-@app.route('/')
+def load_language():
+    return read_language_file(current_app.config['LANGUAGE'])
+
+
+def bump_revision(name='reservations'):
+    stmt = pg_insert(Revision).values(name=name, number=1, updated_at=db.func.now())
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[Revision.name],
+        set_={'number': Revision.number + 1, 'updated_at': db.func.now()},
+    ))
+
+def current_revision(name='reservations'):
+    return db.session.get(Revision, name) or Revision(name=name, number=0)
+
+def reservations_revision():
+    # Not current_revision(): the session may hold a Revision loaded earlier in the transaction
+    return db.session.scalar(db.select(Revision.number).where(Revision.name == 'reservations')) or 0
+
+def load_reservation_index():
+    covered_from = datetime.now() - CALENDAR_HISTORY
+    rows = db.session.execute(
+        db.select(Reservation.start_time, Reservation.end_time, Reservation.id, Reservation.user_id, User.username)
+          .join(User).where(Reservation.end_time > covered_from).order_by(Reservation.start_time)
+    ).all()
+    return IntervalIndex(rows, covered_from)
+
+def reservation_index():
+    """Return the in-memory index of the recent and upcoming reservations, or None when it is disabled."""
+    cache = current_app.extensions['reservation_index']
+    return cache.current() if cache else None
+
+def reservations_committed():
+    # The next lookup in this process reloads the index, the other processes see the new revision
+    if current_app.extensions['reservation_index']:
+        current_app.extensions['reservation_index'].invalidate()
+
+def reservations_changed(start_time, end_time):
+    """Update what is derived from the reservations, in the transaction of the change."""
+    bump_revision()
+
+    # Past days may have been materialized already, drop the whole days touched by the change
+    first_day = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if first_day < start_of_today():
+        last_day = (end_time - timedelta(microseconds=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        db.session.execute(db.delete(OccupancyHour).where(
+            OccupancyHour.hour >= first_day, OccupancyHour.hour < last_day + timedelta(days=1)))
+
+def start_of_today():
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+def hourly_occupancy(start, end):
+    """Select the occupied minutes of every hour in [start, end), computed from the reservations."""
+    hours = (db.func.generate_series(start, end - timedelta(hours=1), timedelta(hours=1))
+               .table_valued(db.column('hour', db.DateTime)).render_derived('hours'))
+    hour_end = hours.c.hour + timedelta(hours=1)
+    overlap = db.func.least(Reservation.end_time, hour_end) - db.func.greatest(Reservation.start_time, hours.c.hour)
+    # least()/greatest() skip NULLs, so hours without reservations must be left out of the sum
+    seconds = db.func.sum(db.func.extract('epoch', overlap)).filter(Reservation.id.isnot(None))
+    minutes = db.func.round(db.func.coalesce(seconds, 0) / 60)
+    return (db.select(hours.c.hour, db.cast(minutes, db.Integer).label('minutes'))
+              .select_from(hours)
+              .outerjoin(Reservation, db.and_(Reservation.start_time < hour_end, Reservation.end_time > hours.c.hour))
+              .group_by(hours.c.hour))
+
+def materialize_occupancy(start, end):
+    """Store the hourly occupancy of the days in [start, end) that are not stored yet."""
+    stored = set(db.session.scalars(
+        db.select(db.func.date_trunc('day', OccupancyHour.hour)).distinct()
+          .where(OccupancyHour.hour >= start, OccupancyHour.hour < end)))
+
+    day = start
+    while day < end:
+        if day in stored:
+            day += timedelta(days=1)
+            continue
+
+        # One INSERT ... SELECT for every run of consecutive missing days
+        span_start = day
+        while day < end and day not in stored:
+            day += timedelta(days=1)
+        db.session.execute(pg_insert(OccupancyHour)
+                           .from_select(['hour', 'minutes'], hourly_occupancy(span_start, day))
+                           .on_conflict_do_nothing())
+    db.session.commit()
+
+def occupancy_report(start, end):
+    """Occupied minutes and utilization of [start, end) by weekday and hour of the day."""
+    today = start_of_today()
+    parts = []
+    if start < min(end, today):
+        materialize_occupancy(start, min(end, today))
+        parts.append(db.select(OccupancyHour.hour, OccupancyHour.minutes)
+                       .where(OccupancyHour.hour >= start, OccupancyHour.hour < min(end, today)))
+    if max(start, today) < end:
+        parts.append(hourly_occupancy(max(start, today), end))
+    hours = db.union_all(*parts).subquery('hours')
+
+    weekday = db.cast(db.func.extract('isodow', hours.c.hour), db.Integer).label('weekday')
+    hour = db.cast(db.func.extract('hour', hours.c.hour), db.Integer).label('hour')
+    rows = db.session.execute(
+        db.select(weekday, hour, db.func.sum(hours.c.minutes).label('minutes'), db.func.count().label('hours'))
+          .group_by(weekday, hour).order_by(weekday, hour)
+    ).all()
+
+    def summarize(key):
+        totals = {}
+        for row in rows:
+            minutes, count = totals.get(getattr(row, key), (0, 0))
+            totals[getattr(row, key)] = (minutes + row.minutes, count + row.hours)
+        return [{key: value, 'occupied_minutes': int(minutes), 'utilization': round(minutes / (count * 60), 4)}
+                for value, (minutes, count) in sorted(totals.items())]
+
+    return {
+        'start': start.date().isoformat(),
+        'end': (end - timedelta(days=1)).date().isoformat(),
+        'buckets': [{'weekday': row.weekday, 'hour': row.hour, 'occupied_minutes': int(row.minutes),
+                     'utilization': round(row.minutes / (row.hours * 60), 4)} for row in rows],
+        'by_weekday': summarize('weekday'),
+        'by_hour': summarize('hour'),
+    }
+
+
+def check_booking(user_id, start_time, end_time):
+    """Return the message key and limit of the first rule the reservation breaks, or None.
+
+    The overlap check and every per-user rule run as one query that also locks the
+    user's row until the end of the transaction, so concurrent bookings of the same
+    user are checked one after the other.
+    """
+    rules = current_app.config['BOOKING_RULES']
+    now = datetime.now()
+
+    if rules['max_lead_days'] and start_time - now > timedelta(days=rules['max_lead_days']):
+        return 'reservation_too_far_ahead', rules['max_lead_days']
+
+    def own(*criteria):
+        # Served by the (user_id, start_time) index
+        return db.select(db.func.count()).where(Reservation.user_id == user_id, *criteria).scalar_subquery()
+
+    checks = {
+        # No reservation is longer than MAX_RESERVATION_DURATION, which bounds the start_time range scanned
+        'overlapping': db.exists().where(Reservation.start_time > start_time - MAX_RESERVATION_DURATION,
+                                         Reservation.start_time < end_time, Reservation.end_time > start_time),
+    }
+    if rules['max_active_reservations']:
+        checks['active'] = own(Reservation.start_time > now - MAX_RESERVATION_DURATION, Reservation.end_time > now)
+    if rules['max_hours_per_week']:
+        week_start = start_time.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=start_time.weekday())
+        week_end = week_start + timedelta(weeks=1)
+        overlap = db.func.least(Reservation.end_time, week_end) - db.func.greatest(Reservation.start_time, week_start)
+        checks['week_seconds'] = db.select(db.func.coalesce(db.func.sum(db.func.extract('epoch', overlap)), 0)).where(
+            Reservation.user_id == user_id,
+            Reservation.start_time > week_start - MAX_RESERVATION_DURATION,
+            Reservation.start_time < week_end,
+            Reservation.end_time > week_start,
+        ).scalar_subquery()
+    if rules['min_gap_minutes']:
+        gap = timedelta(minutes=rules['min_gap_minutes'])
+        checks['too_close'] = own(Reservation.start_time > start_time - gap - MAX_RESERVATION_DURATION,
+                                  Reservation.start_time < end_time + gap, Reservation.end_time > start_time - gap)
+
+    row = db.session.execute(
+        db.select(*(check.label(name) for name, check in checks.items()))
+          .where(User.id == user_id).with_for_update(of=User)
+    ).one()
+
+    if row.overlapping:
+        return 'reservation_overlaps_with_an_existing_one', None
+    if rules['max_active_reservations'] and row.active >= rules['max_active_reservations']:
+        return 'too_many_active_reservations', rules['max_active_reservations']
+    if (rules['max_hours_per_week'] and
+            float(row.week_seconds) + (end_time - start_time).total_seconds() > rules['max_hours_per_week'] * 3600):
+        return 'weekly_hours_limit_exceeded', rules['max_hours_per_week']
+    if rules['min_gap_minutes'] and row.too_close:
+        return 'reservation_too_close_to_another_one', rules['min_gap_minutes']
+    return None
+
+def claim_idempotency_key(user_id, key, message):
+    """Record a submission with its expected outcome and return None, or return the outcome recorded first.
+
+    The row is written in the transaction of the reservation: a concurrent retry waits on the
+    unique index until that transaction ends and then reads the committed outcome.
+    """
+    claimed = db.session.execute(
+        pg_insert(IdempotencyKey).values(user_id=user_id, key=key, message=message, category='success')
+          .on_conflict_do_nothing().returning(IdempotencyKey.id)
+    ).first()
+    if claimed:
+        return None
+    return db.session.execute(
+        db.select(IdempotencyKey.message, IdempotencyKey.category)
+          .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+    ).one()
+
+def reservation_outcome(user_id, idempotency_key, message, category):
+    """Commit a submission that did not add a reservation and flash its outcome."""
+    if idempotency_key:
+        # Keep the claimed key so that retries get the same answer
+        db.session.execute(db.update(IdempotencyKey)
+                           .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == idempotency_key)
+                           .values(message=message, category=category))
+    db.session.commit()
+    flash(message, category)
+    return redirect(url_for('main.index'))
+
+def promote_waitlist(freed_start, freed_end):
+    """Turn the oldest waiting requests that fit in a freed slot into reservations.
+
+    Runs in the transaction that frees the slot. Candidates are found with one range
+    overlap query; SKIP LOCKED leaves entries being promoted by another transaction alone.
+    """
+    # Bounds of the free time around the freed slot
+    gap_start = (db.select(Reservation.end_time).where(Reservation.start_time < freed_start)
+                   .order_by(Reservation.start_time.desc()).limit(1).scalar_subquery())
+    gap_end = (db.select(Reservation.start_time).where(Reservation.start_time >= freed_end)
+                 .order_by(Reservation.start_time).limit(1).scalar_subquery())
+
+    candidates = db.session.scalars(
+        db.select(WaitlistEntry)
+          .where(db.func.tsrange(WaitlistEntry.start_time, WaitlistEntry.end_time)
+                   .op('&&')(db.func.tsrange(freed_start, freed_end)),
+                 WaitlistEntry.start_time >= db.func.coalesce(gap_start, WaitlistEntry.start_time),
+                 WaitlistEntry.end_time <= db.func.coalesce(gap_end, WaitlistEntry.end_time),
+                 WaitlistEntry.start_time > datetime.now())
+          .order_by(WaitlistEntry.created_at, WaitlistEntry.id)
+          .with_for_update(skip_locked=True)
+    ).all()
+
+    promoted = []
+    for entry in candidates:
+        # Requests for the same slot usually overlap each other, skip them without a query
+        if any(entry.start_time < other.end_time and entry.end_time > other.start_time for other in promoted):
+            continue
+        # The booking rules apply to promotions too
+        if check_booking(entry.user_id, entry.start_time, entry.end_time):
+            continue
+        reservation = Reservation(user_id=entry.user_id, start_time=entry.start_time, end_time=entry.end_time)
+        try:
+            with db.session.begin_nested():
+                db.session.add(reservation)
+        except IntegrityError:
+            # Booked meanwhile by a transaction the checks could not see
+            continue
+        db.session.delete(entry)
+        reservations_changed(entry.start_time, entry.end_time)
+        schedule_reminder(reservation)
+        promoted.append(entry)
+    return promoted
+
+def purge_idempotency_keys(batch_size=1000):
+    """Delete the expired idempotency keys in batches, each in its own short transaction."""
+    cutoff = datetime.now(timezone.utc) - current_app.config['IDEMPOTENCY_KEY_TTL']
+    purged = 0
+    while True:
+        expired = (db.select(IdempotencyKey.id).where(IdempotencyKey.created_at < cutoff)
+                     .limit(batch_size).scalar_subquery())
+        deleted = db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.id.in_(expired))).rowcount
+        db.session.commit()
+        purged += deleted
+        if deleted < batch_size:
+            return purged
+
+def schedule_job(kind, run_at=None, key=None, **payload):
+    """Queue a job in the current transaction, once per key."""
+    db.session.execute(pg_insert(Job)
+                       .values(kind=kind, key=key, payload=payload, status='queued', attempts=0,
+                               run_at=run_at or db.func.now())
+                       .on_conflict_do_nothing(index_elements=[Job.key]))
+
+def schedule_reminder(reservation):
+    minutes = current_app.config['REMINDER_MINUTES']
+    if not minutes or reservation.start_time <= datetime.now():
+        return
+    db.session.flush()
+    # Reservations are stored in local time
+    run_at = (reservation.start_time - timedelta(minutes=minutes)).astimezone()
+    schedule_job('reminder', run_at=run_at, key=f'reminder:{reservation.id}', reservation_id=reservation.id)
+
+def cancel_reminder(reservation):
+    db.session.execute(db.delete(Job).where(Job.key == f'reminder:{reservation.id}', Job.status == 'queued'))
+
+def schedule_periodic_jobs():
+    """Queue the daily maintenance jobs, the keys make it safe to call on every worker pass."""
+    today = date.today().isoformat()
+    for kind in ('cleanup', 'warm_analytics'):
+        schedule_job(kind, key=f'{kind}:{today}')
+    db.session.commit()
+
+def send_reminder(reservation_id):
+    reservation = db.session.get(Reservation, reservation_id)
+    if reservation is None or reservation.start_time <= datetime.now():
+        return
+    url = current_app.config['REMINDER_WEBHOOK_URL']
+    if not url:
+        current_app.logger.info('Reminder for %s: reservation from %s to %s', reservation.user.username,
+                                reservation.start_time, reservation.end_time)
+        return
+
+    import urllib.request
+    body = json.dumps({
+        'username': reservation.user.username,
+        'start': reservation.start_time.isoformat(),
+        'end': reservation.end_time.isoformat(),
+    }).encode('utf-8')
+    webhook = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(webhook, timeout=10):
+        pass
+
+def clean_up():
+    """Delete the expired idempotency keys, waitlist requests for past slots and old finished jobs."""
+    purge_idempotency_keys()
+    db.session.execute(db.delete(WaitlistEntry).where(WaitlistEntry.start_time <= datetime.now()))
+    db.session.execute(db.delete(Job).where(Job.status.in_(['done', 'failed']),
+                                            Job.finished_at < datetime.now(timezone.utc) - JOB_RETENTION))
+    db.session.commit()
+
+def warm_analytics():
+    """Store the occupancy of the closed days shown by default on the utilization page."""
+    today = start_of_today()
+    materialize_occupancy(today - timedelta(days=ANALYTICS_DEFAULT_DAYS), today)
+
+JOB_HANDLERS = {
+    'reminder': send_reminder,
+    'cleanup': clean_up,
+    'warm_analytics': warm_analytics,
+}
+
+def claim_jobs(batch_size):
+    """Mark a batch of due jobs as running and commit, so they are not held locked while they run."""
+    now = db.func.now()
+    due = (db.select(Job.id)
+             .where(db.or_(db.and_(Job.status == 'queued', Job.run_at <= now),
+                           db.and_(Job.status == 'running', Job.started_at < now - JOB_TIMEOUT)))
+             .order_by(Job.run_at).limit(batch_size)
+             .with_for_update(skip_locked=True))
+    jobs = db.session.scalars(
+        db.update(Job).where(Job.id.in_(due.scalar_subquery()))
+          .values(status='running', started_at=now, attempts=Job.attempts + 1)
+          .returning(Job)
+          .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+    return jobs
+
+def run_job(job):
+    try:
+        JOB_HANDLERS[job.kind](**job.payload)
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        current_app.logger.exception('Job %s (%s) failed', job.id, job.kind)
+        job.error = str(error)[:255]
+        if job.attempts < JOB_MAX_ATTEMPTS:
+            # Retry later, waiting twice as long after every failure
+            job.status = 'queued'
+            job.run_at = datetime.now(timezone.utc) + timedelta(minutes=2 ** job.attempts)
+            db.session.commit()
+            return False
+        job.status = 'failed'
+    else:
+        job.status = 'done'
+    job.finished_at = datetime.now(timezone.utc)
+    db.session.commit()
+    return job.status == 'done'
+
+def run_jobs(batch_size=JOB_BATCH_SIZE, time_budget=None):
+    """Run the due jobs batch by batch until none is left or the time budget is spent."""
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+    ran = 0
+    while deadline is None or time.monotonic() < deadline:
+        jobs = claim_jobs(batch_size)
+        if not jobs:
+            break
+        for index, job in enumerate(jobs):
+            if deadline is not None and time.monotonic() >= deadline:
+                release_jobs(jobs[index:])
+                return ran
+            run_job(job)
+            ran += 1
+    return ran
+
+def release_jobs(jobs):
+    """Queue claimed jobs that were not run again, without counting the claim as an attempt."""
+    db.session.execute(
+        db.update(Job).where(Job.id.in_([job.id for job in jobs]), Job.status == 'running')
+          .values(status='queued', started_at=None, attempts=Job.attempts - 1)
+          .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+def job_stats():
+    """Queue depth and latency of every kind of job."""
+    now = db.func.now()
+    due = db.and_(Job.status == 'queued', Job.run_at <= now)
+    recent = db.and_(Job.status == 'done', Job.finished_at > now - timedelta(hours=1))
+    rows = db.session.execute(
+        db.select(Job.kind,
+                  db.func.count().filter(due).label('due'),
+                  db.func.count().filter(Job.status == 'queued', Job.run_at > now).label('scheduled'),
+                  db.func.count().filter(Job.status == 'running').label('running'),
+                  db.func.count().filter(Job.status == 'failed').label('failed'),
+                  db.func.extract('epoch', db.func.max(now - Job.run_at).filter(due)).label('oldest_due'),
+                  db.func.extract('epoch', db.func.avg(Job.started_at - Job.run_at).filter(recent)).label('latency'))
+          .group_by(Job.kind).order_by(Job.kind)
+    ).all()
+    return {
+        row.kind: {
+            'due': row.due,
+            'scheduled': row.scheduled,
+            'running': row.running,
+            'failed': row.failed,
+            # Seconds the oldest due job has been waiting, and mean wait of the last hour's jobs
+            'oldest_due_seconds': float(row.oldest_due) if row.oldest_due is not None else None,
+            'latency_seconds': float(row.latency) if row.latency is not None else None,
+        }
+        for row in rows
+    }
+
+def user_stats_query():
+    """Future and total reservations of every user, most active first."""
+    total = db.func.count(Reservation.id)
+    future = db.func.count(Reservation.id).filter(Reservation.start_time > datetime.now())
+    return (db.select(User.username, future.label('future_reservations'), total.label('total_reservations'))
+              .outerjoin(Reservation).group_by(User.id).order_by(total.desc(), User.id))
+
+
+def load_session_versions():
+    """Return the session version of every user whose sessions were revoked at least once."""
+    return dict(db.session.execute(
+        db.select(User.id, User.session_version).where(User.session_version > 0)
+    ).all())
+
+def current_auth():
+    """Return the auth claim of a valid session, or None.
+
+    The claim is signed together with the session cookie, so checking it only needs
+    the in-memory session version cache and no per-request database lookup.
+    """
+    auth = decode_auth(session.get('auth'))
+    if auth is None:
+        return None
+
+    expired = time.time() - auth.issued_at > current_app.config['SESSION_MAX_AGE']
+    if expired or auth.version < current_app.extensions['session_versions'].current(auth.user_id):
+        session.clear()
+        return None
+
+    return auth
+
+def revoke_sessions(user):
+    """Log the user out everywhere by bumping the session version."""
+    user.session_version += 1
+    db.session.commit()
+    current_app.extensions['session_versions'].bump(user.id, user.session_version)
+
+@bp.route('/')
 def home():    
-    db.create_all()
-    if 'username' in session:
-        return redirect(url_for('index'))
-    return redirect(url_for('login'))
+    ensure_schema()
+    if current_auth():
+        return redirect(url_for('main.index'))
+    return redirect(url_for('main.login'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():    
     strings = load_language()
 
-    if 'username' in session:
-        return redirect(url_for('index'))
+    if current_auth():
+        return redirect(url_for('main.index'))
 
     if request.method == 'POST':
         username = request.form.get('username')
@@ -74,58 +783,81 @@ def login():
         user = User.query.filter(db.func.lower(User.username) == db.func.lower(username)).first()
 
         if user and check_password_hash(user.password, password):
+            if user.role == 'disabled':
+                flash(strings['account_disabled'], 'danger')
+                return render_template('login.html', strings=strings)
+
             session['username'] = username
-            session['user_id'] = user.id
+            session['auth'] = encode_auth(user.id, user.role, user.session_version)
             flash(strings['login_successful'], 'success')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         
         flash(strings['invalid_username_or_password'], 'danger')        
     return render_template('login.html', strings=strings)
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():    
     strings = load_language()
 
     session.pop('username', None)
-    session.pop('user_id', None)
+    session.pop('auth', None)
     flash(strings['you_have_been_logged_out'], 'success')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/index')
+@bp.route('/index')
+@read_only
 def index():    
     strings = load_language()
 
-    if 'username' not in session:
+    auth = current_auth()
+    if auth is None:
         flash(strings['please_log_in_to_access_the_system'], 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     # Fetch all reservations for the calendar
     reservations = Reservation.query.join(User).all()
 
     # Fetch reservations for the logged-in user (to cancel)
-    user_reservations = Reservation.query.filter_by(user_id=session['user_id']).all()
+    user_reservations = Reservation.query.filter_by(user_id=auth.user_id).all()
+
+    # Fetch the user's pending waitlist requests
+    waitlist_entries = WaitlistEntry.query.filter(
+        WaitlistEntry.user_id == auth.user_id,
+        WaitlistEntry.start_time > datetime.now()
+    ).order_by(WaitlistEntry.start_time).all()
 
     # Pass both sets of reservations to the template
     return render_template('index.html', 
                            reservations=reservations, 
                            user_reservations=user_reservations,
+                           waitlist_entries=waitlist_entries,
                            username=session['username'],
+                           feed_token=feed_serializer().dumps([auth.user_id, auth.version]),
+                           idempotency_key=uuid.uuid4().hex,
                            strings=strings)
 
-@app.route('/api/reservations')
+@bp.route('/api/reservations')
+@read_only
 def get_reservations():
     strings = load_language()
 
-    if 'username' not in session:
+    if current_auth() is None:
         flash(strings['you_must_be_logged_in_to_view_reservations'], 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     
-    one_week_ago = datetime.now() - timedelta(weeks=1)
-    reservations = Reservation.query.join(User).filter(Reservation.end_time >= one_week_ago).all()
+    one_week_ago = datetime.now() - CALENDAR_HISTORY
+    index = reservation_index()
+    if index and index.covers(one_week_ago):
+        reservations = index.overlapping(one_week_ago, datetime.max)
+    else:
+        reservations = db.session.execute(
+            db.select(Reservation.start_time, Reservation.end_time, User.username)
+              .join(User).where(Reservation.end_time >= one_week_ago)
+        ).all()
     return jsonify([
         {
-            'title': res.user.username,
+            'title': res.username,
             'start': res.start_time.isoformat(),
             'end': res.end_time.isoformat()
         }
@@ -133,14 +865,25 @@ def get_reservations():
     ])
 
 
-@app.route('/add_reservation', methods=['POST'])
+@bp.route('/add_reservation', methods=['POST'])
 def add_reservation():    
     strings = load_language()
 
     # Ensure the user is logged in
-    if 'username' not in session:
+    auth = current_auth()
+    if auth is None:
         flash(strings['you_must_be_logged_in_to_make_a_reservation'], 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
+
+    # A retried submission gets the outcome of the first one without running again
+    idempotency_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    if idempotency_key:
+        if len(idempotency_key) > 64:
+            abort(400)
+        outcome = claim_idempotency_key(auth.user_id, idempotency_key, strings['reservation_successfully_added'])
+        if outcome:
+            flash(outcome.message, outcome.category)
+            return redirect(url_for('main.index'))
 
     # Fetch data from the form
     date = request.form['date']
@@ -151,39 +894,60 @@ def add_reservation():
     start_time = datetime.strptime(f"{date} {start_time_str}", "%Y-%m-%d %H:%M")
     end_time = start_time + timedelta(minutes=duration)
 
-    # Check for overlapping reservations
-    overlapping = Reservation.query.filter(
-        Reservation.start_time < end_time,
-        Reservation.end_time > start_time
-    ).first()
+    if not start_time < end_time <= start_time + MAX_RESERVATION_DURATION:
+        return reservation_outcome(auth.user_id, idempotency_key, strings['invalid_duration'], 'danger')
 
-    if overlapping:
-        flash(strings['reservation_overlaps_with_an_existing_one'], 'danger')
-        return redirect(url_for('index'))
-    
-    # Add the reservation
-    reservation = Reservation(
-        user_id=session['user_id'],
-        start_time=start_time,
-        end_time=end_time
-    )
-    db.session.add(reservation)
+    join_waitlist = request.form.get('join_waitlist')
+    index = reservation_index()
+    if index and not join_waitlist and index.overlapping(start_time, end_time):
+        # Taken according to the in-memory index, which is at most INTERVAL_INDEX_TTL seconds old
+        broken_rule = 'reservation_overlaps_with_an_existing_one', None
+    else:
+        # Check for overlapping reservations and the booking rules
+        broken_rule = check_booking(auth.user_id, start_time, end_time)
+
+    if not broken_rule:
+        reservation = Reservation(
+            user_id=auth.user_id,
+            start_time=start_time,
+            end_time=end_time
+        )
+        try:
+            with db.session.begin_nested():
+                db.session.add(reservation)
+        except IntegrityError:
+            # Another user booked the slot after the check, the exclusion constraint has the last word
+            broken_rule = 'reservation_overlaps_with_an_existing_one', None
+
+    if broken_rule:
+        message, limit = broken_rule
+        if message == 'reservation_overlaps_with_an_existing_one' and join_waitlist:
+            db.session.execute(pg_insert(WaitlistEntry)
+                               .values(user_id=auth.user_id, start_time=start_time, end_time=end_time)
+                               .on_conflict_do_nothing())
+            return reservation_outcome(auth.user_id, idempotency_key, strings['added_to_waitlist'], 'success')
+        return reservation_outcome(auth.user_id, idempotency_key, strings[message].format(limit), 'danger')
+
+    reservations_changed(start_time, end_time)
+    schedule_reminder(reservation)
     db.session.commit()
+    reservations_committed()
 
     flash(strings['reservation_successfully_added'], 'success')
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route('/cancel_reservation', methods=['POST'])
+@bp.route('/cancel_reservation', methods=['POST'])
 def cancel_reservation():    
     strings = load_language()
 
     # Ensure the user is logged in
-    if 'username' not in session:
+    auth = current_auth()
+    if auth is None:
         flash(strings['you_must_be_logged_in_to_cancel_a_reservation'], 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
-    user_id = session['user_id']
+    user_id = auth.user_id
 
 
     reservation_id = request.form.get('reservation_id')
@@ -193,44 +957,207 @@ def cancel_reservation():
     
     if reservation:
         db.session.delete(reservation)
+        reservations_changed(reservation.start_time, reservation.end_time)
+        cancel_reminder(reservation)
+        promote_waitlist(reservation.start_time, reservation.end_time)
         db.session.commit()
+        reservations_committed()
         flash(strings['reservation_successfully_cancelled'], 'success')
     else:
         flash(strings['reservation_not_found_or_not_authorized'], 'danger')
 
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
+
+@bp.route('/leave_waitlist', methods=['POST'])
+def leave_waitlist():
+    strings = load_language()
+
+    auth = current_auth()
+    if auth is None:
+        flash(strings['please_log_in_to_access_the_system'], 'danger')
+        return redirect(url_for('main.login'))
+
+    deleted = WaitlistEntry.query.filter_by(id=request.form.get('waitlist_entry_id'), user_id=auth.user_id).delete()
+    db.session.commit()
+    if deleted:
+        flash(strings['you_left_the_waitlist'], 'success')
+    else:
+        flash(strings['reservation_not_found_or_not_authorized'], 'danger')
+    return redirect(url_for('main.index'))
+
+def feed_serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='calendar-feed')
+
+def feed_user_id(token):
+    """Return the user of a calendar feed link, links die with the user's sessions."""
+    try:
+        user_id, version = feed_serializer().loads(token)
+    except (BadSignature, ValueError, TypeError):
+        abort(404)
+    if version < current_app.extensions['session_versions'].current(user_id):
+        abort(404)
+    return user_id
+
+def calendar_feed(name, summary, *criteria):
+    revision = current_revision()
+    dtstamp = revision.updated_at or datetime.now(timezone.utc)
+    query = (db.select(Reservation.id, Reservation.start_time, Reservation.end_time, User.username)
+             .join(User).where(*criteria).order_by(Reservation.start_time)
+             .execution_options(yield_per=FEED_BATCH_SIZE))
+
+    def generate():
+        yield ics.calendar_header(name)
+        # yield_per streams the rows from a server-side cursor, one batch in memory at a time
+        for rows in db.session.execute(query).partitions():
+            yield ''.join(ics.event(f'reservation-{row.id}@book-a-lot', row.start_time, row.end_time,
+                                    summary or row.username, dtstamp)
+                          for row in rows)
+        yield ics.calendar_footer()
+
+    # Subscribed clients poll often: answer 304 from the revision without running the query
+    response = Response(stream_with_context(generate()), mimetype='text/calendar')
+    response.set_etag(f"{request.endpoint}-{current_app.config['LANGUAGE']}-{revision.number}")
+    response.last_modified = revision.updated_at
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
-@app.route('/stats')
+@bp.route('/calendar/<token>/mine.ics')
+@read_only
+def my_calendar_feed(token):
+    user_id = feed_user_id(token)
+    strings = load_language()
+    return calendar_feed(strings['book-a-lot'], strings['parking_space_reservation'],
+                         Reservation.user_id == user_id)
+
+@bp.route('/calendar/<token>/lot.ics')
+@read_only
+def lot_calendar_feed(token):
+    feed_user_id(token)
+    strings = load_language()
+    return calendar_feed(strings['book-a-lot'], None)
+
+@bp.route('/stats')
+@read_only
 def stats():
     strings = load_language()
 
-    if 'username' not in session:
+    auth = current_auth()
+    if auth is None:
         flash(strings['please_log_in_to_access_the_system'], 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     # Fetch user statistics
-    users = User.query.all()
-    user_stats = []
-    for user in users:
-        total_reservations = Reservation.query.filter_by(user_id=user.id).count()
-        future_reservations = Reservation.query.filter(
-            Reservation.user_id == user.id,
-            Reservation.start_time > datetime.now()
-        ).count()
-        user_stats.append({
-            'username': user.username,
-            'total_reservations': total_reservations,
-            'future_reservations': future_reservations
-        })
-    
-    user_stats.sort(key=lambda x: x['total_reservations'], reverse=True)
+    user_stats = db.session.execute(user_stats_query()).mappings().all()
 
     # Fetch total number of reservations
     total_reservations = Reservation.query.count()
 
-    return render_template('stats.html', user_stats=user_stats, total_reservations=total_reservations, strings=strings)
+    return render_template('stats.html', user_stats=user_stats, total_reservations=total_reservations,
+                           is_admin=auth.role == 'admin', export_formats=export_formats(), strings=strings)
+
+def analytics_range():
+    """Return the [start, end) datetimes of the whole days requested with ?start=&end=."""
+    try:
+        end_day = date.fromisoformat(request.args['end']) if request.args.get('end') else date.today()
+        start_day = (date.fromisoformat(request.args['start']) if request.args.get('start')
+                     else end_day - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1))
+    except ValueError:
+        abort(400)
+    if start_day > end_day or (end_day - start_day).days >= ANALYTICS_MAX_DAYS:
+        abort(400)
+    return datetime.combine(start_day, datetime.min.time()), datetime.combine(end_day + timedelta(days=1), datetime.min.time())
+
+@bp.route('/analytics')
+@read_only
+def analytics():
+    strings = load_language()
+
+    if current_auth() is None:
+        flash(strings['please_log_in_to_access_the_system'], 'danger')
+        return redirect(url_for('main.login'))
+
+    report = occupancy_report(*analytics_range())
+    # Ranges shorter than a week leave some weekdays without buckets
+    grid = {(bucket['hour'], bucket['weekday']): bucket for bucket in report['buckets']}
+    weekdays = {summary['weekday']: summary for summary in report['by_weekday']}
+    return render_template('analytics.html', report=report, grid=grid, weekdays=weekdays, strings=strings)
+
+@bp.route('/api/analytics')
+@read_only
+def get_analytics():
+    strings = load_language()
+
+    if current_auth() is None:
+        flash(strings['please_log_in_to_access_the_system'], 'danger')
+        return redirect(url_for('main.login'))
+
+    return jsonify(occupancy_report(*analytics_range()))
+
+def export_formats():
+    return [fmt for fmt in export.FORMATS if fmt != 'parquet' or export.parquet_available()]
+
+def export_chunks(dataset, fmt):
+    duration = db.cast(db.func.extract('epoch', Reservation.end_time - Reservation.start_time) / 60, db.Integer)
+    columns, query = {
+        'reservations': (
+            [('username', 'string'), ('start_time', 'datetime'), ('end_time', 'datetime'), ('duration_minutes', 'integer')],
+            db.select(User.username, Reservation.start_time, Reservation.end_time, duration)
+              .join(User).order_by(Reservation.start_time),
+        ),
+        'user_stats': (
+            [('username', 'string'), ('future_reservations', 'integer'), ('total_reservations', 'integer')],
+            user_stats_query(),
+        ),
+    }[dataset]
 
-@app.route('/register', methods=['GET', 'POST'])
+    # Server-side cursor: only one batch of rows is held in memory while writing
+    result = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    return export.chunks(fmt, columns, result.partitions())
+
+@bp.route('/admin/export/<dataset>.<fmt>')
+@read_only
+def export_data(dataset, fmt):
+    strings = load_language()
+
+    auth = current_auth()
+    if auth is None:
+        flash(strings['please_log_in_to_access_the_system'], 'danger')
+        return redirect(url_for('main.login'))
+    if auth.role != 'admin':
+        abort(403)
+    if dataset not in EXPORT_DATASETS or fmt not in export_formats():
+        abort(404)
+
+    response = Response(stream_with_context(export_chunks(dataset, fmt)), mimetype=export.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={dataset}.{fmt}'
+    return response
+
+@bp.route('/cron/jobs')
+def cron_jobs():
+    secret = current_app.config['CRON_SECRET']
+    if not secret:
+        abort(404)
+    # Constant time comparison, bytes since compare_digest rejects non-ASCII strings
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {secret}'.encode()):
+        abort(401)
+
+    schedule_periodic_jobs()
+    ran = run_jobs(time_budget=current_app.config['CRON_TIME_BUDGET'])
+    return jsonify({'ran': ran, 'jobs': job_stats()})
+
+@bp.route('/admin/jobs')
+def jobs_status():
+    strings = load_language()
+
+    auth = current_auth()
+    if auth is None:
+        flash(strings['please_log_in_to_access_the_system'], 'danger')
+        return redirect(url_for('main.login'))
+    if auth.role != 'admin':
+        abort(403)
+    return jsonify(job_stats())
+
+@bp.route('/register', methods=['GET', 'POST'])
 def register():    
     strings = load_language()
 
@@ -241,16 +1168,16 @@ def register():
 
         if password != confirm_password:
             flash(strings['passwords_do_not_match'], 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
         
         if not username.isalnum():
             flash(strings['username_must_contain_only_alphanumeric_characters'], 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
         
         existing_user = User.query.filter(db.func.lower(User.username) == db.func.lower(username)).first()        
         if existing_user:
             flash(strings['username_already_exists'], 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
 
         hashed_password = generate_password_hash(password)
         user = User(username=db.func.lower(username), password=hashed_password)
@@ -258,12 +1185,82 @@ def register():
         db.session.commit()
 
         flash(strings['registration_successful_please_log_in'], 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
-    return render_template('register.html', strings=strings, register_enabled=REGISTER_ENABLED)
+    return render_template('register.html', strings=strings, register_enabled=current_app.config['REGISTER_ENABLED'])
+
+
+@bp.cli.command('compile-templates')
+def compile_templates():
+    """Compile all templates into the Jinja bytecode cache."""
+    for name in current_app.jinja_env.list_templates():
+        current_app.jinja_env.get_template(name)
+
+
+@bp.cli.command('export')
+@click.argument('dataset', type=click.Choice(EXPORT_DATASETS))
+@click.option('--format', 'fmt', type=click.Choice(list(export.FORMATS)), default='csv', show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False, allow_dash=True), default='-', help='File to write, - for stdout.')
+def export_command(dataset, fmt, output):
+    """Export all the reservations or the per-user statistics."""
+    if fmt not in export_formats():
+        raise click.ClickException('The parquet format needs the pyarrow package')
+
+    with click.open_file(output, 'wb') as f:
+        for chunk in export_chunks(dataset, fmt):
+            f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+
+
+@bp.cli.command('purge-idempotency-keys')
+@click.option('--batch-size', default=1000, show_default=True)
+def purge_idempotency_keys_command(batch_size):
+    """Delete the idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS."""
+    click.echo(f'Purged {purge_idempotency_keys(batch_size)} idempotency keys')
+
+@bp.cli.command('run-jobs')
+@click.option('--batch-size', default=JOB_BATCH_SIZE, show_default=True)
+@click.option('--poll-interval', default=5.0, show_default=True, help='Seconds to wait when no job is due.')
+@click.option('--once', is_flag=True, help='Exit when no job is due.')
+def run_jobs_command(batch_size, poll_interval, once):
+    """Run the background jobs, several workers can run at the same time."""
+    while True:
+        schedule_periodic_jobs()
+        ran = run_jobs(batch_size)
+        if once:
+            click.echo(f'Ran {ran} jobs')
+            return
+        if not ran:
+            time.sleep(poll_interval)
+
+@bp.cli.command('job-stats')
+def job_stats_command():
+    """Show the queue depth and latency of the background jobs."""
+    click.echo(json.dumps(job_stats(), indent=2))
+
+
+def find_user_or_fail(username):
+    user = User.query.filter(db.func.lower(User.username) == db.func.lower(username)).first()
+    if user is None:
+        raise click.ClickException(f'User {username} not found')
+    return user
+
+@bp.cli.command('force-logout')
+@click.argument('username')
+def force_logout(username):
+    """Revoke every session of a user."""
+    revoke_sessions(find_user_or_fail(username))
 
+@bp.cli.command('set-role')
+@click.argument('username')
+@click.argument('role', type=click.Choice(['user', 'admin', 'disabled']))
+def set_role(username, role):
+    """Change the role of a user and revoke the sessions issued with the old one."""
+    user = find_user_or_fail(username)
+    user.role = role
+    revoke_sessions(user)
 
 
+app = create_app()
 
 if __name__ == '__main__':   
     #app.run(debug=True)
@@ -2,16 +2,57 @@ import unittest
 
 from flask import session
 import os
+import subprocess
+import sys
+import time
 from werkzeug.security import generate_password_hash
 
 os.environ['FLASK_ENV'] = 'testing'
 
-from app import app, db, User, Reservation
-from datetime import datetime, timedelta
+from app import (app, db, User, Reservation, IdempotencyKey, Job, OccupancyHour, WaitlistEntry,
+                 load_reservation_index, reservations_revision, run_jobs, warm_up)
+from auth import encode_auth
+from fragment_cache import BundledBytecodeCache
+from intervals import IntervalIndexCache
+from replicas import ReplicaPool
+from datetime import datetime, timedelta, timezone
 import json
+import csv
+import io
+import importlib.util
+from contextlib import contextmanager
+from unittest import mock
+import tempfile
+import shutil
+from jinja2 import FileSystemLoader
 from bs4 import BeautifulSoup as BS
+from markupsafe import Markup
+from sqlalchemy.exc import OperationalError
 
 LANGUAGE = os.getenv("LANGUAGE")
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1500"))
+# Scrypt hashes take a tenth of a second to make and to check, tests use a single round hash
+TEST_PASSWORD_METHOD = 'pbkdf2:sha256:1'
+SCHEMA = app.config['SQLALCHEMY_ENGINE_OPTIONS']['execution_options']['schema_translate_map'][None]
+
+
+def setUpModule():
+    # The schema is created once, every test runs in a transaction rolled back at the end
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(db.schema.CreateSchema(SCHEMA, if_not_exists=True))
+        db.drop_all()
+        db.create_all()
+
+def tearDownModule():
+    with app.app_context():
+        db.drop_all()
+
+
+def commits(test):
+    """Run a test without the outer transaction, for tests that need other connections to see their data."""
+    test.commits = True
+    return test
 
 
 class AppTestCase(unittest.TestCase):
@@ -23,15 +64,46 @@ class AppTestCase(unittest.TestCase):
 
         self.strings = self.load_language()        
 
-        # Create the database schema
-        with app.app_context():
-            db.create_all()
+        # Every session of the test joins one transaction, their commits only release savepoints
+        self.connection = None
+        if not getattr(getattr(self, self._testMethodName), 'commits', False):
+            with app.app_context():
+                self.connection = db.engine.connect()
+                self.transaction = self.connection.begin()
+                db.session.configure(bind=self.connection, join_transaction_mode='create_savepoint')
+
+        # Session versions of the previous test may be cached
+        app.extensions['session_versions'].clear()
 
     def tearDown(self):
-        # Drop the database schema
         with app.app_context():
             db.session.remove()
-            db.drop_all()
+            if self.connection is None:
+                for table in reversed(db.metadata.sorted_tables):
+                    db.session.execute(db.delete(table))
+                db.session.commit()
+                db.session.remove()
+            else:
+                db.session.configure(bind=None, join_transaction_mode='conditional_savepoint')
+                self.transaction.rollback()
+                self.connection.close()
+
+    @contextmanager
+    def recorded_statements(self):
+        """Collect the SQL statements sent to the database in the block."""
+        statements = []
+        def record(conn, cursor, statement, *args):
+            # Leave out the savepoints standing in for the commits of the test's sessions
+            if 'SAVEPOINT' not in statement:
+                statements.append(statement)
+        # The listeners of an engine are not called for connections opened before they were added
+        with app.app_context():
+            target = self.connection if self.connection is not None else db.engine
+        db.event.listen(target, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            db.event.remove(target, 'before_cursor_execute', record)
     
     def load_language(self):
         with open(f'{LANGUAGE}.json', encoding='utf-8') as f:
@@ -44,7 +116,7 @@ class AppTestCase(unittest.TestCase):
     
     def test_home_redirects_to_index(self):
         with self.app.session_transaction() as sess:
-            sess['username'] = 'testuser'
+            self.set_session_auth(sess)
         response = self.app.get('/')
         self.assertEqual(response.status_code, 302)
         self.assertIn('/index', response.location)
@@ -62,7 +134,7 @@ class AppTestCase(unittest.TestCase):
     
     def test_login_already_logged_in(self):
         with self.app.session_transaction() as sess:
-            sess['username'] = 'testuser'
+            self.set_session_auth(sess)
         response = self.app.get('/login')
         self.assertEqual(response.status_code, 302)
         self.assertIn('/index', response.location)
@@ -80,20 +152,25 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(bytes(self.strings['invalid_username_or_password'],'utf-8'), response.data)
 
-    def create_test_user(self, username='testuser', password='password123'):
+    def create_test_user(self, username='testuser', password='password123', role='user'):
         with app.app_context():
-            test_user = User(username=username, password=generate_password_hash(password))
+            test_user = User(username=username, password=generate_password_hash(password, method=TEST_PASSWORD_METHOD), role=role)
             db.session.add(test_user)
             db.session.commit()
 
             return test_user.id
     
+    def set_session_auth(self, sess, user_id=1, username='testuser', role='user', version=0, issued_at=None):
+        sess['username'] = username
+        sess['auth'] = encode_auth(user_id, role, version, issued_at)
+
     def do_login(self, username='testuser', password='password123'):
         response = self.app.post('/login', data=dict(username=username, password=password), follow_redirects=True)
         self.assertEqual(response.status_code, 200)
         self.assertIn(bytes(self.strings['login_successful'],'utf-8'), response.data)
         with self.app.session_transaction() as sess:
             self.assertIn('username', sess)
+            self.assertIn('auth', sess)
     
     def do_logout(self):
         response = self.app.get('/logout', follow_redirects=True)
@@ -104,13 +181,160 @@ class AppTestCase(unittest.TestCase):
 
     def test_logout(self):
         with self.app.session_transaction() as sess:
-            sess['username'] = 'testuser'
+            self.set_session_auth(sess)
         response = self.app.get('/logout', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
         self.assertIn(bytes(self.strings['you_have_been_logged_out'],'utf-8'), response.data)
         with self.app.session_transaction() as sess:
             self.assertNotIn('username', sess)
     
+    def test_forged_session_without_auth_is_rejected(self):
+        with self.app.session_transaction() as sess:
+            sess['username'] = 'testuser'
+            sess['user_id'] = 1
+        response = self.app.get('/index')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login', response.location)
+
+    def test_expired_session_is_rejected(self):
+        with self.app.session_transaction() as sess:
+            self.set_session_auth(sess, issued_at=time.time() - app.config['SESSION_MAX_AGE'] - 1)
+        response = self.app.get('/index')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login', response.location)
+
+    def test_force_logout(self):
+        self.create_test_user()
+        self.do_login()
+
+        result = app.test_cli_runner().invoke(args=['force-logout', 'testuser'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        response = self.app.get('/index', follow_redirects=True)
+        self.assertIn(bytes(self.strings['please_log_in_to_access_the_system'], 'utf-8'), response.data)
+        with self.app.session_transaction() as sess:
+            self.assertNotIn('auth', sess)
+
+        # Logging in again issues a session with the new version
+        self.do_login()
+        response = self.app.get('/index')
+        self.assertEqual(response.status_code, 200)
+
+    def test_force_logout_unknown_user(self):
+        result = app.test_cli_runner().invoke(args=['force-logout', 'nobody'])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_disabled_user_cannot_log_in(self):
+        self.create_test_user()
+        self.do_login()
+
+        result = app.test_cli_runner().invoke(args=['set-role', 'testuser', 'disabled'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        response = self.app.get('/index')
+        self.assertEqual(response.status_code, 302)
+
+        response = self.app.post('/login', data=dict(username='testuser', password='password123'), follow_redirects=True)
+        self.assertIn(bytes(self.strings['account_disabled'], 'utf-8'), response.data)
+        with self.app.session_transaction() as sess:
+            self.assertNotIn('auth', sess)
+
+    def test_session_check_does_not_query_users(self):
+        self.create_test_user()
+        self.do_login()
+        self.app.get('/api/reservations')
+
+        with self.recorded_statements() as statements:
+            response = self.app.get('/api/reservations')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('reservations', statements[0])
+
+    def use_replica(self, healthy=True):
+        """Route the read-only views to a stand-in replica: a second engine on the test database.
+
+        The replica cannot see uncommitted data, so the tests using it must be marked with @commits.
+        """
+        with app.app_context():
+            engines = db.engines
+            replica = db.create_engine(db.engine.url, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+            primary = db.engine
+        engines['replica_0'] = replica
+        self.addCleanup(replica.dispose)
+        self.addCleanup(engines.pop, 'replica_0')
+
+        original = app.extensions['read_replicas']
+        app.extensions['read_replicas'] = ReplicaPool(['replica_0'], lambda name: healthy, 30)
+        self.addCleanup(app.extensions.__setitem__, 'read_replicas', original)
+
+        statements = {'primary': [], 'replica': []}
+        for name, engine in [('primary', primary), ('replica', replica)]:
+            def record(conn, cursor, statement, *args, name=name):
+                statements[name].append(statement)
+            db.event.listen(engine, 'before_cursor_execute', record)
+            self.addCleanup(db.event.remove, engine, 'before_cursor_execute', record)
+        return statements
+
+    @commits
+    def test_read_only_views_use_replica(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        statements = self.use_replica()
+
+        for url in ['/api/reservations', '/stats', '/index']:
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(statements['primary'], [])
+        self.assertTrue(any('reservations' in statement for statement in statements['replica']))
+
+        # Writes go to the primary, and so do the user's reads that follow
+        self.add_reservation(test_user_id, datetime.now().strftime('%Y-%m-%d'), '10:00', '60')
+        self.assertTrue(any(statement.startswith('INSERT INTO') for statement in statements['primary']))
+        self.assertFalse(any(statement.startswith('INSERT INTO') for statement in statements['replica']))
+        with self.app.session_transaction() as sess:
+            self.assertGreater(sess['read_primary_until'], time.time())
+
+        statements['replica'].clear()
+        response = self.app.get('/api/reservations')
+        self.assertEqual(len(response.get_json()), 1)
+        self.assertEqual(statements['replica'], [])
+
+        # Once the pin expires the replica serves the user again
+        with self.app.session_transaction() as sess:
+            sess['read_primary_until'] = 0
+        statements['primary'].clear()
+        self.app.get('/api/reservations')
+        self.assertEqual(statements['primary'], [])
+        self.assertNotEqual(statements['replica'], [])
+
+    @commits
+    def test_reads_after_a_write_use_primary(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        self.add_reservation(test_user_id, '2025-03-03', '10:00', '60')
+        with self.app.session_transaction() as sess:
+            sess['read_primary_until'] = 0
+        statements = self.use_replica()
+
+        # The closed days are stored first, then read back with the rest of the report
+        report = self.get_analytics('2025-03-03', '2025-03-09')
+        self.assertEqual(report['by_weekday'][0]['occupied_minutes'], 60)
+        self.assertTrue(any(statement.startswith('INSERT INTO') for statement in statements['primary']))
+        self.assertFalse(any('isodow' in statement for statement in statements['replica']))
+        self.assertTrue(any('isodow' in statement for statement in statements['primary']))
+
+    @commits
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        self.create_test_user()
+        self.do_login()
+        statements = self.use_replica(healthy=False)
+
+        response = self.app.get('/api/reservations')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(statements['replica'], [])
+        self.assertNotEqual(statements['primary'], [])
+
     def test_index_not_logged_in(self):
         response = self.app.get('/index')
         self.assertEqual(response.status_code, 302)
@@ -238,6 +462,254 @@ class AppTestCase(unittest.TestCase):
 
 
 
+    def test_overlapping_reservations_are_rejected_by_the_database(self):
+        test_user_id = self.create_test_user()
+        with app.app_context():
+            db.session.add(Reservation(user_id=test_user_id, start_time=datetime(2026, 1, 1, 10), end_time=datetime(2026, 1, 1, 11)))
+            db.session.commit()
+            db.session.add(Reservation(user_id=test_user_id, start_time=datetime(2026, 1, 1, 10, 30), end_time=datetime(2026, 1, 1, 12)))
+            with self.assertRaises(db.exc.IntegrityError):
+                db.session.commit()
+
+    def test_concurrent_booking_of_the_slot_is_rejected(self):
+        reservation_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        test_user_id = self.create_test_user()
+        test_user_2_id = self.create_test_user('testuser2')
+        self.do_login()
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+        self.do_logout()
+
+        # The slot is taken between the checks and the insert
+        self.do_login('testuser2')
+        with mock.patch('app.check_booking', return_value=None):
+            response = self.post_reservation(reservation_date, '10:30', '60', 'key-1')
+        self.assertIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+        self.assertEqual(self.count_reservations(test_user_2_id), 0)
+
+        # The answer is recorded for retries
+        response = self.post_reservation(reservation_date, '10:30', '60', 'key-1')
+        self.assertIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+
+    def use_reservation_index(self):
+        original = app.extensions['reservation_index']
+        app.extensions['reservation_index'] = IntervalIndexCache(load_reservation_index, reservations_revision, 60)
+        self.addCleanup(app.extensions.__setitem__, 'reservation_index', original)
+
+    def test_reservation_index(self):
+        reservation_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        test_user_id = self.create_test_user()
+        test_user_2_id = self.create_test_user('testuser2')
+        self.use_reservation_index()
+        self.do_login()
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+        with app.app_context():
+            # A reservation older than the calendar window is left out
+            old = datetime.now() - timedelta(weeks=2)
+            db.session.add(Reservation(user_id=test_user_id, start_time=old, end_time=old + timedelta(hours=1)))
+            db.session.commit()
+        self.do_logout()
+
+        self.do_login('testuser2')
+        with self.recorded_statements() as statements:
+            # Loaded once, then the lookups do not query the reservations
+            self.assertEqual(len(self.app.get('/api/reservations').get_json()), 1)
+            statements.clear()
+            reservations = self.app.get('/api/reservations').get_json()
+            self.app.post('/add_reservation', data=dict(date=reservation_date, start_time='10:30', duration='60'))
+        self.assertEqual(reservations[0]['title'], 'testuser')
+        response = self.app.get('/index')
+        self.assertIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+        self.assertFalse(any(f'FROM {SCHEMA}.reservations' in statement for statement in statements))
+
+        # The index follows the writes of the process
+        self.add_reservation(test_user_2_id, reservation_date, '11:00', '60')
+        self.assertEqual(len(self.app.get('/api/reservations').get_json()), 2)
+
+    def set_booking_rules(self, **rules):
+        original = app.config['BOOKING_RULES']
+        app.config['BOOKING_RULES'] = {**original, **rules}
+        self.addCleanup(app.config.__setitem__, 'BOOKING_RULES', original)
+
+    def assert_rejected(self, response, message, limit):
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(bytes(self.strings[message].format(limit), 'utf-8'), response.data)
+
+    def count_reservations(self, user_id):
+        with app.app_context():
+            return Reservation.query.filter_by(user_id=user_id).count()
+
+    def test_add_reservation_invalid_duration(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        reservation_date = datetime.now().strftime('%Y-%m-%d')
+
+        for duration in ['0', '-30', '1500']:
+            response = self.add_reservation(test_user_id, reservation_date, '10:00', duration, skipChecks=True)
+            self.assertIn(bytes(self.strings['invalid_duration'], 'utf-8'), response.data)
+        self.assertEqual(self.count_reservations(test_user_id), 0)
+
+    def test_max_active_reservations(self):
+        self.set_booking_rules(max_active_reservations=2)
+        test_user_id = self.create_test_user()
+        self.do_login()
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+        # Past reservations do not count
+        self.add_reservation(test_user_id, yesterday, '10:00', '60')
+        self.add_reservation(test_user_id, tomorrow, '10:00', '60', skipChecks=True)
+        self.add_reservation(test_user_id, tomorrow, '12:00', '60', skipChecks=True)
+        response = self.add_reservation(test_user_id, tomorrow, '14:00', '60', skipChecks=True)
+        self.assert_rejected(response, 'too_many_active_reservations', 2)
+        self.assertEqual(self.count_reservations(test_user_id), 3)
+
+    def test_max_hours_per_week(self):
+        self.set_booking_rules(max_hours_per_week=3)
+        test_user_id = self.create_test_user()
+        self.do_login()
+        today = datetime.now()
+        monday = today + timedelta(days=7 - today.weekday())
+        tuesday = monday + timedelta(days=1)
+        next_monday = monday + timedelta(weeks=1)
+
+        self.add_reservation(test_user_id, monday.strftime('%Y-%m-%d'), '10:00', '120')
+        response = self.add_reservation(test_user_id, tuesday.strftime('%Y-%m-%d'), '10:00', '90', skipChecks=True)
+        self.assert_rejected(response, 'weekly_hours_limit_exceeded', 3)
+        self.add_reservation(test_user_id, tuesday.strftime('%Y-%m-%d'), '10:00', '60', skipChecks=True)
+        self.add_reservation(test_user_id, next_monday.strftime('%Y-%m-%d'), '10:00', '180', skipChecks=True)
+        self.assertEqual(self.count_reservations(test_user_id), 3)
+
+    def test_max_lead_days(self):
+        self.set_booking_rules(max_lead_days=7)
+        test_user_id = self.create_test_user()
+        self.do_login()
+
+        response = self.add_reservation(test_user_id, (datetime.now() + timedelta(days=10)).strftime('%Y-%m-%d'), '10:00', '60', skipChecks=True)
+        self.assert_rejected(response, 'reservation_too_far_ahead', 7)
+        self.add_reservation(test_user_id, (datetime.now() + timedelta(days=3)).strftime('%Y-%m-%d'), '10:00', '60')
+
+    def test_min_gap_between_own_reservations(self):
+        self.set_booking_rules(min_gap_minutes=60)
+        test_user_id = self.create_test_user()
+        self.do_login()
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+
+        self.add_reservation(test_user_id, tomorrow, '10:00', '60')
+        response = self.add_reservation(test_user_id, tomorrow, '11:30', '60', skipChecks=True)
+        self.assert_rejected(response, 'reservation_too_close_to_another_one', 60)
+        self.add_reservation(test_user_id, tomorrow, '12:00', '60', skipChecks=True)
+        self.assertEqual(self.count_reservations(test_user_id), 2)
+
+        # The gap only applies to the user's own reservations
+        self.do_logout()
+        test_user_2_id = self.create_test_user(username='testuser2')
+        self.do_login(username='testuser2')
+        self.add_reservation(test_user_2_id, tomorrow, '11:00', '60')
+
+    def test_overlap_with_a_day_long_reservation(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        tomorrow = datetime.now() + timedelta(days=1)
+        self.add_reservation(test_user_id, tomorrow.strftime('%Y-%m-%d'), '11:00', str(24 * 60))
+
+        # Starts almost a day later, still inside the bounded start_time range
+        day_after = (tomorrow + timedelta(days=1)).strftime('%Y-%m-%d')
+        response = self.add_reservation(test_user_id, day_after, '10:30', '60', skipChecks=True)
+        self.assertIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+        self.assertEqual(self.count_reservations(test_user_id), 1)
+
+    def test_booking_checks_use_one_query(self):
+        self.set_booking_rules(max_active_reservations=5, max_hours_per_week=10, max_lead_days=30, min_gap_minutes=30)
+        test_user_id = self.create_test_user()
+        self.do_login()
+        self.app.get('/api/reservations')
+
+        with self.recorded_statements() as statements:
+            self.app.post('/add_reservation', data=dict(date=datetime.now().strftime('%Y-%m-%d'), start_time='10:00', duration='60'))
+
+        selects = [statement for statement in statements if statement.lstrip().startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+        self.assertIn('FOR UPDATE', selects[0])
+        self.assertEqual(self.count_reservations(test_user_id), 1)
+
+    def post_reservation(self, reservation_date, reservation_time, duration, key, use_header=False):
+        data = dict(date=reservation_date, start_time=reservation_time, duration=duration)
+        headers = {}
+        if use_header:
+            headers['Idempotency-Key'] = key
+        else:
+            data['idempotency_key'] = key
+        return self.app.post('/add_reservation', data=data, headers=headers, follow_redirects=True)
+
+    def test_repeated_submission_returns_original_outcome(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        reservation_date = datetime.now().strftime('%Y-%m-%d')
+
+        for _ in range(2):
+            response = self.post_reservation(reservation_date, '10:00', '60', 'key-1')
+            self.assertIn(bytes(self.strings['reservation_successfully_added'], 'utf-8'), response.data)
+            self.assertNotIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+        self.assertEqual(self.count_reservations(test_user_id), 1)
+
+        # A new key is a new submission
+        response = self.post_reservation(reservation_date, '10:00', '60', 'key-2', use_header=True)
+        self.assertIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+
+    def test_repeated_rejected_submission_is_not_run_again(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        reservation_date = datetime.now().strftime('%Y-%m-%d')
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+
+        response = self.post_reservation(reservation_date, '10:00', '60', 'key-1', use_header=True)
+        self.assertIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+
+        with app.app_context():
+            reservation_id = Reservation.query.filter_by(user_id=test_user_id).first().id
+        self.app.post('/cancel_reservation', data=dict(reservation_id=reservation_id))
+
+        response = self.post_reservation(reservation_date, '10:00', '60', 'key-1', use_header=True)
+        self.assertIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+        self.assertEqual(self.count_reservations(test_user_id), 0)
+
+    def test_idempotency_keys_are_per_user(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        self.post_reservation(datetime.now().strftime('%Y-%m-%d'), '10:00', '60', 'key-1')
+        self.do_logout()
+
+        test_user_2_id = self.create_test_user(username='testuser2')
+        self.do_login(username='testuser2')
+        self.post_reservation((datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d'), '10:00', '60', 'key-1')
+        self.assertEqual(self.count_reservations(test_user_id), 1)
+        self.assertEqual(self.count_reservations(test_user_2_id), 1)
+
+    def test_index_renders_a_new_idempotency_key(self):
+        self.create_test_user()
+        self.do_login()
+
+        keys = []
+        for _ in range(2):
+            soup = BS(self.app.get('/index').data, 'html.parser')
+            keys.append(soup.find('input', attrs={'name': 'idempotency_key'})['value'])
+        self.assertNotEqual(keys[0], keys[1])
+
+    def test_purge_idempotency_keys(self):
+        test_user_id = self.create_test_user()
+        with app.app_context():
+            old = datetime.now(timezone.utc) - app.config['IDEMPOTENCY_KEY_TTL'] - timedelta(hours=1)
+            for i in range(5):
+                db.session.add(IdempotencyKey(user_id=test_user_id, key=f'old-{i}', message='ok', category='success', created_at=old))
+            db.session.add(IdempotencyKey(user_id=test_user_id, key='new', message='ok', category='success'))
+            db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['purge-idempotency-keys', '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Purged 5', result.output)
+        with app.app_context():
+            self.assertEqual([key.key for key in IdempotencyKey.query.all()], ['new'])
+
     def test_cancel_reservation(self):
         reservation_date = datetime.now().strftime('%Y-%m-%d')
         reservation_time = '10:00'        
@@ -505,6 +977,125 @@ class AppTestCase(unittest.TestCase):
             self.assertEqual(reservation_2.end_time, end_time_2)
 
             self.assertEqual(reservation_2.user_id, test_user_2_id)
+
+    def join_waitlist(self, reservation_date, reservation_time, duration):
+        return self.app.post('/add_reservation', data=dict(
+            date=reservation_date, start_time=reservation_time, duration=duration, join_waitlist='1'
+        ), follow_redirects=True)
+
+    def test_join_waitlist_when_slot_is_taken(self):
+        reservation_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        test_user_id = self.create_test_user()
+        test_user_2_id = self.create_test_user('testuser2')
+
+        self.do_login()
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+        self.do_logout()
+
+        self.do_login('testuser2')
+        response = self.join_waitlist(reservation_date, '10:30', '60')
+        self.assertIn(bytes(self.strings['added_to_waitlist'], 'utf-8'), response.data)
+        self.assertIn(bytes(self.strings['waitlist'], 'utf-8'), response.data)
+        # Joining twice keeps one entry
+        self.join_waitlist(reservation_date, '10:30', '60')
+        self.assertEqual(self.count_reservations(test_user_2_id), 0)
+        with app.app_context():
+            self.assertEqual(WaitlistEntry.query.filter_by(user_id=test_user_2_id).count(), 1)
+
+        # Without the flag an overlapping request is only rejected
+        response = self.add_reservation(test_user_2_id, reservation_date, '10:00', '30', skipChecks=True)
+        self.assertIn(bytes(self.strings['reservation_overlaps_with_an_existing_one'], 'utf-8'), response.data)
+        with app.app_context():
+            self.assertEqual(WaitlistEntry.query.count(), 1)
+
+    def test_cancel_reservation_promotes_waitlist(self):
+        reservation_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        test_user_id = self.create_test_user()
+        test_user_2_id = self.create_test_user('testuser2')
+        test_user_3_id = self.create_test_user('testuser3')
+        test_user_4_id = self.create_test_user('testuser4')
+
+        self.do_login()
+        self.add_reservation(test_user_id, reservation_date, '10:00', '120')
+        self.add_reservation(test_user_id, reservation_date, '12:00', '60', skipChecks=True)
+        self.do_logout()
+
+        # The oldest request wins, a later one for the same slot keeps waiting
+        for username, reservation_time, duration in [('testuser2', '10:00', '60'),
+                                                     ('testuser3', '10:30', '60'),
+                                                     ('testuser4', '11:30', '60')]:
+            self.do_login(username)
+            self.join_waitlist(reservation_date, reservation_time, duration)
+            self.do_logout()
+
+        self.do_login()
+        with app.app_context():
+            reservation = Reservation.query.filter_by(user_id=test_user_id).order_by(Reservation.start_time).first()
+        response = self.app.post('/cancel_reservation', data=dict(reservation_id=reservation.id), follow_redirects=True)
+        self.assertIn(bytes(self.strings['reservation_successfully_cancelled'], 'utf-8'), response.data)
+
+        self.assertEqual(self.count_reservations(test_user_2_id), 1)
+        self.assertEqual(self.count_reservations(test_user_3_id), 0)
+        # The request running into the 12:00 reservation does not fit in the freed slot
+        self.assertEqual(self.count_reservations(test_user_4_id), 0)
+        with app.app_context():
+            waiting = sorted(entry.user_id for entry in WaitlistEntry.query.all())
+        self.assertEqual(waiting, [test_user_3_id, test_user_4_id])
+
+    def test_waitlist_promotion_follows_booking_rules(self):
+        reservation_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        test_user_id = self.create_test_user()
+        test_user_2_id = self.create_test_user('testuser2')
+        test_user_3_id = self.create_test_user('testuser3')
+        self.set_booking_rules(max_active_reservations=1)
+
+        self.do_login()
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+        self.do_logout()
+
+        self.do_login('testuser2')
+        self.add_reservation(test_user_2_id, reservation_date, '14:00', '60')
+        self.join_waitlist(reservation_date, '10:00', '60')
+        self.do_logout()
+        self.do_login('testuser3')
+        self.join_waitlist(reservation_date, '10:00', '60')
+        self.do_logout()
+
+        self.do_login()
+        with app.app_context():
+            reservation = Reservation.query.filter_by(user_id=test_user_id).first()
+        self.app.post('/cancel_reservation', data=dict(reservation_id=reservation.id), follow_redirects=True)
+
+        # testuser2 already has as many reservations as allowed, the slot goes to testuser3
+        self.assertEqual(self.count_reservations(test_user_2_id), 1)
+        self.assertEqual(self.count_reservations(test_user_3_id), 1)
+
+    def test_leave_waitlist(self):
+        reservation_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        test_user_id = self.create_test_user()
+        self.create_test_user('testuser2')
+
+        self.do_login()
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+        self.do_logout()
+
+        self.do_login('testuser2')
+        self.join_waitlist(reservation_date, '10:00', '60')
+        with app.app_context():
+            entry_id = WaitlistEntry.query.first().id
+        self.do_logout()
+
+        # Only the owner can remove the entry
+        self.do_login()
+        response = self.app.post('/leave_waitlist', data=dict(waitlist_entry_id=entry_id), follow_redirects=True)
+        self.assertIn(bytes(self.strings['reservation_not_found_or_not_authorized'], 'utf-8'), response.data)
+        self.do_logout()
+
+        self.do_login('testuser2')
+        response = self.app.post('/leave_waitlist', data=dict(waitlist_entry_id=entry_id), follow_redirects=True)
+        self.assertIn(bytes(self.strings['you_left_the_waitlist'], 'utf-8'), response.data)
+        with app.app_context():
+            self.assertEqual(WaitlistEntry.query.count(), 0)
     
     # tests for api/reservations
     def test_reservations_api(self):
@@ -596,6 +1187,81 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'[]', response.data)
     
+    def get_feed_urls(self):
+        response = self.app.get('/index')
+        soup = BS(response.data, 'html.parser')
+        links = [a['href'] for a in soup.find_all('a') if a['href'].endswith('.ics')]
+        self.assertEqual(len(links), 2)
+        return links
+
+    def test_calendar_feeds(self):
+        reservation_date = datetime.now().strftime('%Y-%m-%d')
+        reservation_date_2 = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+
+        test_user_id = self.create_test_user()
+        self.do_login()
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+        self.do_logout()
+
+        test_user_2_id = self.create_test_user(username='testuser2', password='password123')
+        self.do_login(username='testuser2', password='password123')
+        self.add_reservation(test_user_2_id, reservation_date_2, '10:00', '90')
+        my_feed, lot_feed = self.get_feed_urls()
+
+        response = self.app.get(my_feed)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/calendar')
+        body = response.get_data(as_text=True)
+        self.assertTrue(body.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertTrue(body.endswith('END:VCALENDAR\r\n'))
+        self.assertEqual(body.count('BEGIN:VEVENT'), 1)
+        start_time = datetime.strptime(f'{reservation_date_2} 10:00', '%Y-%m-%d %H:%M')
+        self.assertIn(f"DTSTART:{start_time.strftime('%Y%m%dT%H%M%S')}", body)
+        self.assertIn(f"DTEND:{(start_time + timedelta(minutes=90)).strftime('%Y%m%dT%H%M%S')}", body)
+
+        response = self.app.get(lot_feed)
+        self.assertEqual(response.status_code, 200)
+        body = response.get_data(as_text=True)
+        self.assertEqual(body.count('BEGIN:VEVENT'), 2)
+        self.assertIn('SUMMARY:testuser\r\n', body)
+        self.assertIn('SUMMARY:testuser2\r\n', body)
+
+    def test_calendar_feed_not_modified(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        self.add_reservation(test_user_id, datetime.now().strftime('%Y-%m-%d'), '10:00', '60')
+        my_feed, lot_feed = self.get_feed_urls()
+
+        response = self.app.get(lot_feed)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        response = self.app.get(lot_feed, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        response = self.app.get(lot_feed, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # A new reservation changes the feed
+        self.add_reservation(test_user_id, datetime.now().strftime('%Y-%m-%d'), '12:00', '60', skipChecks=True)
+        response = self.app.get(lot_feed, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True).count('BEGIN:VEVENT'), 2)
+
+    def test_calendar_feed_invalid_token(self):
+        response = self.app.get('/calendar/not-a-token/mine.ics')
+        self.assertEqual(response.status_code, 404)
+
+    def test_calendar_feed_revoked_by_force_logout(self):
+        self.create_test_user()
+        self.do_login()
+        my_feed, lot_feed = self.get_feed_urls()
+
+        app.test_cli_runner().invoke(args=['force-logout', 'testuser'])
+        self.assertEqual(self.app.get(my_feed).status_code, 404)
+        self.assertEqual(self.app.get(lot_feed).status_code, 404)
+
     # test /stats page
     def test_stats_page(self):
         reservation_date = datetime.now().strftime('%Y-%m-%d')
@@ -638,6 +1304,409 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(bytes(self.strings['please_log_in_to_access_the_system'],'utf-8'), response.data)
 
+    def test_index_fragments_are_cached(self):
+        self.create_test_user()
+        self.do_login()
+
+        fragment_cache = app.jinja_env.fragment_cache
+        fragment_cache.clear()
+        self.addCleanup(fragment_cache.clear)
+
+        response = self.app.get('/index')
+        self.assertEqual(response.status_code, 200)
+        key = ('index_footer', self.strings['language'], self.strings['version'])
+        self.assertIn(key, fragment_cache)
+
+        # The cached fragment is reused, the user-specific parts are rendered again
+        fragment_cache[key] = Markup('<footer>cached footer</footer>')
+        response = self.app.get('/index')
+        self.assertIn(b'cached footer', response.data)
+        self.assertIn(b'testuser', response.data)
+
+    def test_compile_templates(self):
+        result = app.test_cli_runner().invoke(args=['compile-templates'])
+        self.assertEqual(result.exit_code, 0)
+
+    def test_read_only_bytecode_cache(self):
+        # The cache shipped with a serverless function cannot be written to, rendering must still work
+        with tempfile.TemporaryDirectory() as directory:
+            bytecode_cache = BundledBytecodeCache(os.path.join(directory, 'missing'))
+            env = app.jinja_env.overlay(bytecode_cache=bytecode_cache, cache_size=0)
+            self.assertEqual(env.from_string('{{ 1 + 1 }}').render(), '2')
+            self.assertEqual(env.get_template('analytics.html').name, 'analytics.html')
+
+    def test_bytecode_cache_is_relocatable(self):
+        # The cache is filled before the deployment and shipped with the app to another path
+        with tempfile.TemporaryDirectory() as directory:
+            built, deployed = os.path.join(directory, 'built'), os.path.join(directory, 'deployed')
+            shutil.copytree(os.path.join(app.root_path, app.template_folder), os.path.join(built, 'templates'))
+            env = app.jinja_env.overlay(loader=FileSystemLoader(os.path.join(built, 'templates')),
+                                        bytecode_cache=BundledBytecodeCache(os.path.join(built, 'jinja_cache')),
+                                        cache_size=0)
+            os.makedirs(os.path.join(built, 'jinja_cache'))
+            env.get_template('index.html')
+            shutil.copytree(built, deployed)
+
+            env = app.jinja_env.overlay(loader=FileSystemLoader(os.path.join(deployed, 'templates')),
+                                        bytecode_cache=BundledBytecodeCache(os.path.join(deployed, 'jinja_cache')),
+                                        cache_size=0)
+            with mock.patch.object(env, 'compile', side_effect=AssertionError('template compiled again')):
+                self.assertEqual(env.get_template('index.html').name, 'index.html')
+
+    # Parallel test workers (pytest-xdist) compete for the CPU with the measured import
+    @unittest.skipIf(os.getenv("PYTEST_XDIST_WORKER"), "the import time is only measured in serial runs")
+    def test_import_time_budget(self):
+        # Importing the app is the cold start cost: it must stay within budget and not touch the database
+        code = 'import app\nwith app.app.app_context(): print(app.db.engine.pool.checkedin())'
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env={**os.environ, 'WARM_UP_ON_START': 'false'})
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '0')
+
+        app_line = [line for line in result.stderr.splitlines() if line.split('|')[-1].strip() == 'app'][-1]
+        cumulative_ms = int(app_line.split('|')[1]) / 1000
+        self.assertLess(cumulative_ms, IMPORT_TIME_BUDGET_MS)
+
+    def test_warm_up_opens_a_connection(self):
+        with app.app_context():
+            db.engine.dispose()
+            warm_up(app)
+            self.assertEqual(db.engine.pool.checkedin(), 1)
+
+    def test_warm_up_without_database(self):
+        error = OperationalError('SELECT 1', {}, Exception('connection refused'))
+        with mock.patch('app.ensure_schema', side_effect=error), self.assertLogs(app.logger, 'WARNING') as logs:
+            warm_up(app)
+        self.assertIn('Warm-up failed', logs.output[0])
+
+    def create_export_data(self):
+        test_user_id = self.create_test_user(role='admin')
+        self.do_login()
+        self.add_reservation(test_user_id, '2025-03-01', '10:00', '90')
+        self.add_reservation(test_user_id, '2025-03-02', '10:00', '30', skipChecks=True)
+
+    def test_export_reservations_csv(self):
+        self.create_export_data()
+
+        response = self.app.get('/stats')
+        self.assertIn(b'/admin/export/reservations.csv', response.data)
+
+        response = self.app.get('/admin/export/reservations.csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows, [
+            ['username', 'start_time', 'end_time', 'duration_minutes'],
+            ['testuser', '2025-03-01 10:00:00', '2025-03-01 11:30:00', '90'],
+            ['testuser', '2025-03-02 10:00:00', '2025-03-02 10:30:00', '30'],
+        ])
+
+    def test_export_user_stats_csv(self):
+        self.create_export_data()
+        self.create_test_user(username='testuser2')
+
+        response = self.app.get('/admin/export/user_stats.csv')
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows, [
+            ['username', 'future_reservations', 'total_reservations'],
+            ['testuser', '0', '2'],
+            ['testuser2', '0', '0'],
+        ])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_export_reservations_parquet(self):
+        import pyarrow.parquet as pq
+        self.create_export_data()
+
+        response = self.app.get('/admin/export/reservations.parquet')
+        self.assertEqual(response.status_code, 200)
+        table = pq.read_table(io.BytesIO(response.data))
+        self.assertEqual(table.column('username').to_pylist(), ['testuser', 'testuser'])
+        self.assertEqual(table.column('duration_minutes').to_pylist(), [90, 30])
+        self.assertEqual(table.column('start_time').to_pylist()[0], datetime(2025, 3, 1, 10, 0))
+
+    def test_export_requires_admin(self):
+        self.create_test_user()
+        self.do_login()
+
+        response = self.app.get('/stats')
+        self.assertNotIn(b'/admin/export/', response.data)
+
+        response = self.app.get('/admin/export/reservations.csv')
+        self.assertEqual(response.status_code, 403)
+
+    def test_export_unknown_dataset(self):
+        self.create_test_user(role='admin')
+        self.do_login()
+
+        response = self.app.get('/admin/export/users.csv')
+        self.assertEqual(response.status_code, 404)
+
+    def test_export_command(self):
+        self.create_export_data()
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'reservations.csv')
+            result = app.test_cli_runner().invoke(args=['export', 'reservations', '--output', output])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(output, encoding='utf-8') as f:
+                self.assertEqual(len(list(csv.reader(f))), 3)
+
+    def get_analytics(self, start, end):
+        response = self.app.get(f'/api/analytics?start={start}&end={end}')
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_analytics_api(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        # 2025-03-03 is a Monday
+        self.add_reservation(test_user_id, '2025-03-03', '10:00', '90')
+
+        report = self.get_analytics('2025-03-03', '2025-03-04')
+        self.assertEqual(report['start'], '2025-03-03')
+        self.assertEqual(report['end'], '2025-03-04')
+        self.assertEqual(len(report['buckets']), 48)
+        self.assertIn({'weekday': 1, 'hour': 10, 'occupied_minutes': 60, 'utilization': 1.0}, report['buckets'])
+        self.assertIn({'weekday': 1, 'hour': 11, 'occupied_minutes': 30, 'utilization': 0.5}, report['buckets'])
+        self.assertIn({'weekday': 2, 'hour': 10, 'occupied_minutes': 0, 'utilization': 0.0}, report['buckets'])
+        self.assertEqual(report['by_hour'][10], {'hour': 10, 'occupied_minutes': 60, 'utilization': 0.5})
+        self.assertEqual(report['by_weekday'][0], {'weekday': 1, 'occupied_minutes': 90, 'utilization': round(90 / (24 * 60), 4)})
+
+        # Closed days are stored once
+        with app.app_context():
+            self.assertEqual(OccupancyHour.query.count(), 48)
+
+    def test_analytics_closed_days_follow_changes(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        self.add_reservation(test_user_id, '2025-03-03', '10:00', '60')
+        self.assertEqual(self.get_analytics('2025-03-03', '2025-03-03')['by_hour'][10]['occupied_minutes'], 60)
+
+        with app.app_context():
+            reservation_id = Reservation.query.filter_by(user_id=test_user_id).first().id
+        self.app.post('/cancel_reservation', data=dict(reservation_id=reservation_id))
+        self.assertEqual(self.get_analytics('2025-03-03', '2025-03-03')['by_hour'][10]['occupied_minutes'], 0)
+
+        self.add_reservation(test_user_id, '2025-03-03', '15:30', '60')
+        report = self.get_analytics('2025-03-03', '2025-03-03')
+        self.assertEqual(report['by_hour'][15]['occupied_minutes'], 30)
+        self.assertEqual(report['by_hour'][16]['occupied_minutes'], 30)
+
+    def test_analytics_today_is_not_stored(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        today = datetime.now().strftime('%Y-%m-%d')
+        self.add_reservation(test_user_id, today, '10:00', '60')
+
+        report = self.get_analytics(today, today)
+        self.assertEqual(report['by_hour'][10]['occupied_minutes'], 60)
+        with app.app_context():
+            self.assertEqual(OccupancyHour.query.count(), 0)
+
+    def test_analytics_invalid_range(self):
+        self.create_test_user()
+        self.do_login()
+
+        self.assertEqual(self.app.get('/api/analytics?start=2025-03-04&end=2025-03-03').status_code, 400)
+        self.assertEqual(self.app.get('/api/analytics?start=yesterday').status_code, 400)
+        self.assertEqual(self.app.get('/api/analytics?start=2020-01-01&end=2025-01-01').status_code, 400)
+
+    def test_analytics_page(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        self.add_reservation(test_user_id, '2025-03-03', '10:00', '60')
+
+        response = self.app.get('/analytics?start=2025-03-03&end=2025-03-09')
+        self.assertEqual(response.status_code, 200)
+        soup = BS(response.data, 'html.parser')
+        row = soup.find('table').find('tbody').find_all('tr')[10]
+        self.assertEqual([td.text for td in row.find_all(['td', 'th'])][:3], ['10:00', '100%', '0%'])
+
+    def test_analytics_page_shorter_than_a_week(self):
+        test_user_id = self.create_test_user()
+        self.do_login()
+        self.add_reservation(test_user_id, '2025-03-03', '10:00', '60')
+
+        # 2025-03-03 is a Monday, the other weekdays have no hours in the range
+        response = self.app.get('/analytics?start=2025-03-03&end=2025-03-03')
+        self.assertEqual(response.status_code, 200)
+        soup = BS(response.data, 'html.parser')
+        row = soup.find('table').find('tbody').find_all('tr')[10]
+        self.assertEqual([td.text for td in row.find_all(['td', 'th'])], ['10:00', '100%', '', '', '', '', '', '', '100%'])
+        footer = soup.find('table').find('tfoot').find_all('th')
+        self.assertEqual(len(footer), 9)
+        self.assertEqual([th.text for th in footer[2:8]], [''] * 6)
+
+    def test_analytics_not_logged_in(self):
+        response = self.app.get('/api/analytics', follow_redirects=True)
+        self.assertIn(bytes(self.strings['please_log_in_to_access_the_system'], 'utf-8'), response.data)
+
+    def set_config(self, **config):
+        for name, value in config.items():
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+
+    def queue_job(self, kind, **columns):
+        with app.app_context():
+            job = Job(kind=kind, **columns)
+            db.session.add(job)
+            db.session.commit()
+            return job.id
+
+    def get_job(self, job_id):
+        with app.app_context():
+            job = db.session.get(Job, job_id)
+            db.session.expunge(job)
+            return job
+
+    def test_reminder_follows_the_reservation(self):
+        self.set_config(REMINDER_MINUTES=30)
+        test_user_id = self.create_test_user()
+        self.do_login()
+        reservation_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+
+        with app.app_context():
+            reservation = Reservation.query.first()
+            job = Job.query.filter_by(kind='reminder').one()
+            self.assertEqual(job.payload, {'reservation_id': reservation.id})
+            self.assertEqual(job.run_at, (reservation.start_time - timedelta(minutes=30)).astimezone())
+
+        self.app.post('/cancel_reservation', data=dict(reservation_id=reservation.id))
+        with app.app_context():
+            self.assertEqual(Job.query.count(), 0)
+
+    def test_run_reminder_job(self):
+        self.set_config(REMINDER_MINUTES=30)
+        test_user_id = self.create_test_user()
+        self.do_login()
+        reservation_date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        self.add_reservation(test_user_id, reservation_date, '10:00', '60')
+        with app.app_context():
+            # Make the reminder due, now() in the database is the start of the test's transaction
+            job = Job.query.one()
+            job.run_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+            db.session.commit()
+
+            with self.assertLogs(app.logger, 'INFO') as logs:
+                self.assertEqual(run_jobs(), 1)
+            self.assertIn('Reminder for testuser', logs.output[0])
+            self.assertEqual(Job.query.one().status, 'done')
+            # Done jobs are not run again
+            self.assertEqual(run_jobs(), 0)
+
+    def test_failed_job_is_retried_later(self):
+        job_id = self.queue_job('unknown')
+        with app.app_context(), self.assertLogs(app.logger, 'ERROR'):
+            self.assertEqual(run_jobs(), 1)
+        job = self.get_job(job_id)
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at, datetime.now(timezone.utc))
+        self.assertIsNotNone(job.error)
+
+        # The last attempt marks the job as failed
+        with app.app_context():
+            db.session.execute(db.update(Job).values(run_at=db.func.now(), attempts=4))
+            db.session.commit()
+            with self.assertLogs(app.logger, 'ERROR'):
+                run_jobs()
+        job = self.get_job(job_id)
+        self.assertEqual((job.status, job.attempts), ('failed', 5))
+
+    @commits
+    def test_locked_jobs_are_skipped(self):
+        locked_id = self.queue_job('cleanup')
+        free_id = self.queue_job('cleanup')
+        with app.app_context():
+            with db.engine.connect() as connection:
+                # Another worker holds the first job
+                connection.execute(db.select(Job).where(Job.id == locked_id).with_for_update())
+                self.assertEqual(run_jobs(), 1)
+        self.assertEqual(self.get_job(locked_id).status, 'queued')
+        self.assertEqual(self.get_job(free_id).status, 'done')
+
+    def test_lost_running_job_is_run_again(self):
+        job_id = self.queue_job('cleanup', status='running', attempts=1,
+                                started_at=datetime.now(timezone.utc) - timedelta(hours=1))
+        recent_id = self.queue_job('cleanup', status='running', attempts=1, started_at=datetime.now(timezone.utc))
+        with app.app_context():
+            self.assertEqual(run_jobs(), 1)
+        self.assertEqual((self.get_job(job_id).status, self.get_job(job_id).attempts), ('done', 2))
+        self.assertEqual(self.get_job(recent_id).status, 'running')
+
+    def test_jobs_past_the_time_budget_are_released(self):
+        job_ids = [self.queue_job('slow') for _ in range(3)]
+        with app.app_context(), mock.patch.dict('app.JOB_HANDLERS', slow=lambda: time.sleep(0.1)):
+            self.assertEqual(run_jobs(time_budget=0.05), 1)
+        jobs = [self.get_job(job_id) for job_id in job_ids]
+        self.assertEqual(sorted(job.status for job in jobs), ['done', 'queued', 'queued'])
+        # The claim of the jobs that did not run is not counted as an attempt
+        self.assertEqual([(job.attempts, job.started_at) for job in jobs if job.status == 'queued'], [(0, None)] * 2)
+
+    def test_cleanup_job(self):
+        test_user_id = self.create_test_user()
+        with app.app_context():
+            yesterday = datetime.now() - timedelta(days=1)
+            db.session.add(WaitlistEntry(user_id=test_user_id, start_time=yesterday, end_time=yesterday + timedelta(hours=1)))
+            db.session.add(WaitlistEntry(user_id=test_user_id, start_time=yesterday + timedelta(days=2),
+                                         end_time=yesterday + timedelta(days=2, hours=1)))
+            old = datetime.now(timezone.utc) - app.config['IDEMPOTENCY_KEY_TTL'] - timedelta(hours=1)
+            db.session.add(IdempotencyKey(user_id=test_user_id, key='old', message='ok', category='success', created_at=old))
+            db.session.add(Job(kind='reminder', status='done', finished_at=datetime.now(timezone.utc) - timedelta(days=2)))
+            db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['run-jobs', '--once'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Ran 2 jobs', result.output)
+        with app.app_context():
+            self.assertEqual(WaitlistEntry.query.count(), 1)
+            self.assertEqual(IdempotencyKey.query.count(), 0)
+            self.assertEqual(sorted(job.kind for job in Job.query.all()), ['cleanup', 'warm_analytics'])
+            # The closed days of the default utilization range are stored
+            self.assertEqual(OccupancyHour.query.count(), 28 * 24)
+
+    def test_cron_jobs(self):
+        self.assertEqual(self.app.get('/cron/jobs').status_code, 404)
+
+        self.set_config(CRON_SECRET='cron-secret')
+        self.assertEqual(self.app.get('/cron/jobs', headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+        self.assertEqual(self.app.get('/cron/jobs', headers={'Authorization': 'Bearer é'}).status_code, 401)
+        response = self.app.get('/cron/jobs', headers={'Authorization': 'Bearer cron-secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['ran'], 2)
+
+        # The daily jobs are queued once
+        response = self.app.get('/cron/jobs', headers={'Authorization': 'Bearer cron-secret'})
+        self.assertEqual(response.get_json()['ran'], 0)
+
+    def test_job_stats(self):
+        self.create_test_user(role='admin')
+        self.do_login()
+        self.queue_job('reminder', run_at=datetime.now(timezone.utc) - timedelta(minutes=5))
+        self.queue_job('reminder', run_at=datetime.now(timezone.utc) + timedelta(hours=1))
+        self.queue_job('cleanup', status='done', run_at=datetime.now(timezone.utc) - timedelta(seconds=30),
+                       started_at=datetime.now(timezone.utc), finished_at=datetime.now(timezone.utc))
+
+        stats = self.app.get('/admin/jobs').get_json()
+        self.assertEqual((stats['reminder']['due'], stats['reminder']['scheduled']), (1, 1))
+        self.assertAlmostEqual(stats['reminder']['oldest_due_seconds'], 300, delta=5)
+        self.assertIsNone(stats['reminder']['latency_seconds'])
+        self.assertAlmostEqual(stats['cleanup']['latency_seconds'], 30, delta=5)
+
+        result = app.test_cli_runner().invoke(args=['job-stats'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(json.loads(result.output)['reminder']['due'], 1)
+
+    def test_job_stats_requires_admin(self):
+        self.create_test_user()
+        self.do_login()
+        self.assertEqual(self.app.get('/admin/jobs').status_code, 403)
+
     def test_register_page_loads(self):
         response = self.app.get('/register')
         self.assertEqual(response.status_code, 200)
@@ -0,0 +1,43 @@
+import time
+from collections import namedtuple
+
+
+# Compact auth claim stored in the signed session cookie
+Auth = namedtuple('Auth', 'user_id role issued_at version')
+
+
+def encode_auth(user_id, role, version, issued_at=None):
+    return [user_id, role, int(issued_at if issued_at is not None else time.time()), version]
+
+
+def decode_auth(value):
+    if not isinstance(value, list) or len(value) != len(Auth._fields):
+        return None
+    return Auth(*value)
+
+
+class SessionVersionCache:
+    """Keeps the session version of every user whose sessions were revoked.
+
+    The whole map is reloaded at most once per ttl seconds, so checking a
+    session is a dictionary lookup. Users missing from the map are at version 0.
+    """
+
+    def __init__(self, loader, ttl):
+        self._loader = loader
+        self._ttl = ttl
+        self._versions = {}
+        self._expires_at = 0
+
+    def current(self, user_id):
+        now = time.monotonic()
+        if now >= self._expires_at:
+            self._versions = self._loader()
+            self._expires_at = now + self._ttl
+        return self._versions.get(user_id, 0)
+
+    def bump(self, user_id, version):
+        self._versions[user_id] = version
+
+    def clear(self):
+        self._expires_at = 0
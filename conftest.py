@@ -0,0 +1,102 @@
+"""pytest hooks: an optional disposable PostgreSQL server and the suite runtime benchmark.
+
+TEST_POSTGRES=disposable runs the suite against a throwaway server created with
+initdb and pg_ctl (from PATH, or from PG_BIN). TEST_BENCHMARK_FILE appends the
+runtime of every run to a JSON lines file, TEST_SUITE_BUDGET_SECONDS fails a run
+that takes longer.
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+
+started_at = pytest.StashKey()
+postgres_dir = pytest.StashKey()
+runtime = pytest.StashKey()
+
+
+def is_worker(config):
+    # pytest-xdist workers inherit the environment, and so the server, of the main process
+    return hasattr(config, 'workerinput')
+
+
+def pg_tool(name):
+    return os.path.join(os.environ['PG_BIN'], name) if os.getenv('PG_BIN') else name
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_postgres():
+    """Start a PostgreSQL server in a temporary directory and point the PG* variables at it."""
+    directory = tempfile.mkdtemp(prefix='book-a-lot-postgres-')
+    data = os.path.join(directory, 'data')
+    port = free_port()
+    subprocess.run([pg_tool('initdb'), '-D', data, '-U', 'postgres', '--auth=trust', '--no-sync'],
+                   check=True, capture_output=True)
+    # Durability is useless for a database thrown away at the end of the run
+    options = f'-h 127.0.0.1 -p {port} -k {directory} -c fsync=off -c synchronous_commit=off -c full_page_writes=off'
+    subprocess.run([pg_tool('pg_ctl'), '-D', data, '-o', options, '-l', os.path.join(directory, 'postgres.log'),
+                    '-w', 'start'], check=True, capture_output=True)
+    os.environ.update(PGHOST='127.0.0.1', PGPORT=str(port), PGUSER='postgres', PGPASSWORD='', PGDATABASE='postgres')
+    return directory
+
+
+def stop_postgres(directory):
+    subprocess.run([pg_tool('pg_ctl'), '-D', os.path.join(directory, 'data'), '-m', 'immediate', 'stop'],
+                   capture_output=True)
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def pytest_configure(config):
+    config.stash[started_at] = time.monotonic()
+    if os.getenv('TEST_POSTGRES') == 'disposable' and not is_worker(config):
+        config.stash[postgres_dir] = start_postgres()
+
+
+def pytest_unconfigure(config):
+    if postgres_dir in config.stash:
+        stop_postgres(config.stash[postgres_dir])
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if is_worker(session.config):
+        return
+    seconds = time.monotonic() - session.config.stash[started_at]
+    session.config.stash[runtime] = seconds
+
+    path = os.getenv('TEST_BENCHMARK_FILE')
+    if path:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({
+                'finished_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'seconds': round(seconds, 3),
+                'tests': session.testscollected,
+                'workers': getattr(session.config.option, 'numprocesses', None) or 1,
+                'exit_status': int(exitstatus),
+            }) + '\n')
+
+    budget = os.getenv('TEST_SUITE_BUDGET_SECONDS')
+    if budget and seconds > float(budget) and exitstatus == pytest.ExitCode.OK:
+        session.exitstatus = pytest.ExitCode.TESTS_FAILED
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    if runtime not in config.stash:
+        return
+    seconds = config.stash[runtime]
+    budget = os.getenv('TEST_SUITE_BUDGET_SECONDS')
+    line = f'suite runtime {seconds:.2f}s'
+    if budget:
+        line += f' (budget {float(budget):.2f}s)'
+    terminalreporter.write_sep('-', line, red=bool(budget) and seconds > float(budget))
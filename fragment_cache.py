@@ -0,0 +1,56 @@
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+
+class BundledBytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache that can be shipped read-only with a deployment.
+
+    Serverless bundles are read-only: templates missing from the shipped cache, or
+    compiled by another Python version, are compiled in memory instead of failing.
+    The entries are keyed by template name only, since the app does not run from the
+    path where the cache was filled; the source checksum still catches stale entries.
+    """
+
+    def get_cache_key(self, name, filename=None):
+        return super().get_cache_key(name)
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+
+class FragmentCacheExtension(Extension):
+    """Adds a {% cache %} tag that renders a template fragment once and reuses it.
+
+    The tag takes one or more key expressions, e.g.
+    {% cache 'reservation_form', strings['language'], strings['version'] %}
+    so only parts that do not depend on the logged-in user should be cached.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache={})
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_cache_support', [nodes.List(args)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _cache_support(self, key, caller):
+        key = tuple(key)
+        rv = self.environment.fragment_cache.get(key)
+        if rv is None:
+            rv = caller()
+            self.environment.fragment_cache[key] = rv
+        return rv
@@ -0,0 +1,64 @@
+from datetime import timezone
+
+
+CRLF = '\r\n'
+
+
+def escape_text(value):
+    return (value.replace('\\', '\\\\').replace(';', '\\;')
+                 .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def fold(line):
+    """Split a content line into chunks of at most 75 octets."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + CRLF
+
+    chunks = []
+    limit = 75
+    while encoded:
+        cut = min(limit, len(encoded))
+        # Never split a multi-byte character
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        chunks.append(encoded[:cut].decode('utf-8'))
+        encoded = encoded[cut:]
+        limit = 74  # continuation lines start with a space
+    return (CRLF + ' ').join(chunks) + CRLF
+
+
+def format_local(value):
+    # Reservations are stored in local time, so they are written as floating times
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def format_utc(value):
+    # Aware datetimes come in the time zone of the database session
+    return value.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def calendar_header(name):
+    return ''.join(fold(line) for line in [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//book-a-lot//book-a-lot//EN',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{escape_text(name)}',
+    ])
+
+
+def calendar_footer():
+    return fold('END:VCALENDAR')
+
+
+def event(uid, start, end, summary, dtstamp):
+    return ''.join(fold(line) for line in [
+        'BEGIN:VEVENT',
+        f'UID:{uid}',
+        f'DTSTAMP:{format_utc(dtstamp)}',
+        f'DTSTART:{format_local(start)}',
+        f'DTEND:{format_local(end)}',
+        f'SUMMARY:{escape_text(summary)}',
+        'END:VEVENT',
+    ])
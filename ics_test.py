@@ -0,0 +1,42 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import ics
+
+
+class IcsTestCase(unittest.TestCase):
+
+    def test_escape_text(self):
+        self.assertEqual(ics.escape_text('a,b;c\\d\ne'), 'a\\,b\\;c\\\\d\\ne')
+
+    def test_short_line_is_not_folded(self):
+        self.assertEqual(ics.fold('SUMMARY:test'), 'SUMMARY:test\r\n')
+
+    def test_long_line_is_folded(self):
+        line = 'SUMMARY:' + 'è' * 100
+        folded = ics.fold(line)
+        parts = folded[:-2].split('\r\n')
+        self.assertGreater(len(parts), 1)
+        for part in parts:
+            self.assertLessEqual(len(part.encode('utf-8')), 75)
+        self.assertEqual(''.join(part[1:] if i else part for i, part in enumerate(parts)), line)
+
+    def test_format_utc_converts_to_utc(self):
+        rome = timezone(timedelta(hours=2))
+        self.assertEqual(ics.format_utc(datetime(2026, 6, 1, 10, 30, tzinfo=rome)), '20260601T083000Z')
+        self.assertEqual(ics.format_utc(datetime(2026, 6, 1, 10, 30, tzinfo=timezone.utc)), '20260601T103000Z')
+
+    def test_event(self):
+        event = ics.event('reservation-1@book-a-lot', datetime(2026, 1, 2, 10, 0), datetime(2026, 1, 2, 11, 30),
+                          'testuser', datetime(2026, 1, 1, 8, 0, tzinfo=timezone.utc))
+        self.assertEqual(event, 'BEGIN:VEVENT\r\n'
+                                'UID:reservation-1@book-a-lot\r\n'
+                                'DTSTAMP:20260101T080000Z\r\n'
+                                'DTSTART:20260102T100000\r\n'
+                                'DTEND:20260102T113000\r\n'
+                                'SUMMARY:testuser\r\n'
+                                'END:VEVENT\r\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import time
+from bisect import bisect_left, bisect_right
+
+
+class IntervalIndex:
+    """Reservations sorted by start time, for overlap and window lookups in O(log n).
+
+    The intervals must not overlap each other, which the exclusion constraint on the
+    reservations guarantees: the end times are then sorted too and both bounds of a
+    window can be found with bisect.
+    """
+
+    def __init__(self, items, covered_from):
+        # items are tuples starting with (start_time, end_time), sorted by start_time
+        self._items = list(items)
+        self._starts = [item[0] for item in self._items]
+        self._ends = [item[1] for item in self._items]
+        self.covered_from = covered_from
+
+    def __len__(self):
+        return len(self._items)
+
+    def covers(self, start):
+        return start >= self.covered_from
+
+    def overlapping(self, start, end):
+        """Return the items overlapping [start, end), sorted by start time."""
+        return self._items[bisect_right(self._ends, start):bisect_left(self._starts, end)]
+
+
+class IntervalIndexCache:
+    """Keeps an IntervalIndex in step with the revision of the reservations.
+
+    The revision is read at most once per ttl seconds, and the whole index is
+    reloaded when it changed. invalidate() forces the reload on the next use.
+    """
+
+    def __init__(self, loader, revision, ttl):
+        self._loader = loader
+        self._revision = revision
+        self._ttl = ttl
+        self._index = None
+        self._version = None
+        self._expires_at = 0
+
+    def current(self):
+        now = time.monotonic()
+        index = self._index
+        if index is None or now >= self._expires_at:
+            # Read the revision first: the loaded index is then at least as new as the version
+            version = self._revision()
+            if index is None or version != self._version:
+                index = self._loader()
+                self._index, self._version = index, version
+            self._expires_at = now + self._ttl
+        return index
+
+    def invalidate(self):
+        self._index = None
@@ -0,0 +1,71 @@
+import unittest
+from datetime import datetime, timedelta
+
+from intervals import IntervalIndex, IntervalIndexCache
+
+
+def at(hour):
+    return datetime(2026, 1, 1) + timedelta(hours=hour)
+
+
+class IntervalIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = IntervalIndex([(at(1), at(2), 'a'), (at(2), at(4), 'b'), (at(6), at(7), 'c')], at(0))
+
+    def test_overlapping(self):
+        self.assertEqual([item[2] for item in self.index.overlapping(at(1.5), at(3))], ['a', 'b'])
+        self.assertEqual([item[2] for item in self.index.overlapping(at(3), at(10))], ['b', 'c'])
+        self.assertEqual([item[2] for item in self.index.overlapping(at(0), at(24))], ['a', 'b', 'c'])
+
+    def test_touching_intervals_do_not_overlap(self):
+        self.assertEqual(self.index.overlapping(at(4), at(6)), [])
+        self.assertEqual(self.index.overlapping(at(0), at(1)), [])
+        self.assertEqual(self.index.overlapping(at(7), at(8)), [])
+
+    def test_covers(self):
+        self.assertTrue(self.index.covers(at(0)))
+        self.assertFalse(self.index.covers(at(-1)))
+
+    def test_empty_index(self):
+        index = IntervalIndex([], at(0))
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.overlapping(at(0), at(1)), [])
+
+
+class IntervalIndexCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.revision = 1
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return IntervalIndex([], at(0))
+
+    def test_reload_on_new_revision(self):
+        cache = IntervalIndexCache(self.load, lambda: self.revision, 0)
+        cache.current()
+        cache.current()
+        self.assertEqual(self.loads, 1)
+        self.revision = 2
+        cache.current()
+        self.assertEqual(self.loads, 2)
+
+    def test_revision_is_checked_once_per_ttl(self):
+        cache = IntervalIndexCache(self.load, lambda: self.revision, 60)
+        cache.current()
+        self.revision = 2
+        cache.current()
+        self.assertEqual(self.loads, 1)
+
+    def test_invalidate(self):
+        cache = IntervalIndexCache(self.load, lambda: self.revision, 60)
+        cache.current()
+        cache.invalidate()
+        cache.current()
+        self.assertEqual(self.loads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
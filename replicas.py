@@ -0,0 +1,33 @@
+import time
+
+
+class ReplicaPool:
+    """Hands out the read replicas in turn, skipping the ones that fail their health check.
+
+    Each replica is checked again at most once per interval seconds, so picking one
+    is usually a dictionary lookup. When no replica is healthy the reads go to the primary.
+    """
+
+    def __init__(self, names, check, interval):
+        self._names = list(names)
+        self._check = check
+        self._interval = interval
+        self._next = 0
+        self._healthy = {}
+        self._checked_at = {}
+
+    def __bool__(self):
+        return bool(self._names)
+
+    def pick(self):
+        """Return the name of the next healthy replica, or None."""
+        now = time.monotonic()
+        for _ in range(len(self._names)):
+            name = self._names[self._next % len(self._names)]
+            self._next += 1
+            if name not in self._checked_at or now - self._checked_at[name] >= self._interval:
+                self._healthy[name] = self._check(name)
+                self._checked_at[name] = now
+            if self._healthy[name]:
+                return name
+        return None
@@ -0,0 +1,46 @@
+import unittest
+from unittest import mock
+
+from replicas import ReplicaPool
+
+
+class ReplicaPoolTestCase(unittest.TestCase):
+
+    def test_round_robin(self):
+        pool = ReplicaPool(['a', 'b'], lambda name: True, 30)
+        self.assertEqual([pool.pick() for _ in range(4)], ['a', 'b', 'a', 'b'])
+
+    def test_unhealthy_replica_is_skipped(self):
+        pool = ReplicaPool(['a', 'b'], lambda name: name == 'b', 30)
+        self.assertEqual([pool.pick() for _ in range(3)], ['b', 'b', 'b'])
+
+    def test_no_healthy_replica(self):
+        pool = ReplicaPool(['a'], lambda name: False, 30)
+        self.assertIsNone(pool.pick())
+
+    def test_empty_pool(self):
+        pool = ReplicaPool([], lambda name: True, 30)
+        self.assertFalse(pool)
+        self.assertIsNone(pool.pick())
+
+    def test_health_is_checked_once_per_interval(self):
+        checks = []
+        healthy = {'a': False}
+        def check(name):
+            checks.append(name)
+            return healthy[name]
+        pool = ReplicaPool(['a'], check, 30)
+
+        with mock.patch('replicas.time.monotonic', return_value=100):
+            self.assertIsNone(pool.pick())
+            healthy['a'] = True
+            self.assertIsNone(pool.pick())
+        self.assertEqual(checks, ['a'])
+
+        with mock.patch('replicas.time.monotonic', return_value=130):
+            self.assertEqual(pool.pick(), 'a')
+        self.assertEqual(checks, ['a', 'a'])
+
+
+if __name__ == '__main__':
+    unittest.main()